@@ -1,29 +1,142 @@
+import os
 import torch
-from numpy.lib.recfunctions import structured_to_unstructured
+from functools import partial
+from multiprocessing import Pool
+from numpy.lib.recfunctions import structured_to_unstructured, unstructured_to_structured
 from scipy.spatial import cKDTree
 import numpy as np
 from scipy.interpolate import griddata
+from tqdm import tqdm
 
 default_rng = np.random.default_rng(135)
 
 
 __all__ = [
+    'PointCloud',
+    'position',
     'filter_range',
+    'grid_keys',
     'filter_grid',
     'filter_cylinder',
     'filter_box',
     'valid_point_mask',
     'estimate_heightmap',
+    'rasterize_footprints',
     'hm_to_cloud',
     'affine',
     'inverse',
     'within_bounds',
     'points2range_img',
+    'segment_ground',
     'merge_heightmaps',
+    'VoxelMap',
+    'build_voxel_map',
+    'save_points',
+    'load_points',
 ]
 
+class PointCloud:
+    """
+    Point cloud stored in a contiguous float32 (N x C) buffer with named columns.
+
+    Columns are returned as views of the buffer (`cloud['z']`, `cloud.xyz`), so they can be read
+    and modified without copying. Structured arrays (`.npz` files, `ros_numpy`) are converted
+    only when loading and saving the cloud.
+
+    Example:
+    ```
+    cloud = PointCloud.load(npz_path)
+    cloud.transform(Tr)
+    cloud = cloud[cloud['z'] < 1.]
+    ```
+    """
+
+    def __init__(self, data, fields=('x', 'y', 'z')):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        fields = tuple(fields)
+        assert data.ndim == 2 and data.shape[1] == len(fields), 'Invalid cloud shape %s' % (data.shape,)
+        assert fields[:3] == ('x', 'y', 'z'), 'First three fields must be x, y, z, got %s' % (fields,)
+        self.data = data
+        self.fields = fields
+
+    @staticmethod
+    def from_structured(cloud, fields=None):
+        assert isinstance(cloud, np.ndarray) and cloud.dtype.names, 'Structured array expected'
+        cloud = cloud.ravel()
+        if fields is None:
+            fields = ['x', 'y', 'z'] + [f for f in cloud.dtype.names
+                                        if f not in ('x', 'y', 'z') and cloud.dtype[f].kind in 'fiub'
+                                        and cloud.dtype[f].shape == ()]
+        data = np.empty((len(cloud), len(fields)), dtype=np.float32)
+        for j, f in enumerate(fields):
+            data[:, j] = cloud[f]
+        return PointCloud(data, fields)
+
+    @staticmethod
+    def from_msg(msg, fields=None):
+        from ros_numpy import numpify
+        return PointCloud.from_structured(numpify(msg), fields=fields)
+
+    @staticmethod
+    def load(path, key='cloud', fields=None):
+        """Load a cloud stored as structured array in an .npz file."""
+        return PointCloud.from_structured(np.load(path)[key], fields=fields)
+
+    def to_structured(self):
+        return unstructured_to_structured(self.data, names=list(self.fields))
+
+    def to_msg(self, frame_id=None, stamp=None):
+        from ros_numpy import msgify
+        from sensor_msgs.msg import PointCloud2
+        msg = msgify(PointCloud2, self.to_structured())
+        if frame_id is not None:
+            msg.header.frame_id = frame_id
+        if stamp is not None:
+            msg.header.stamp = stamp
+        return msg
+
+    def save(self, path, key='cloud'):
+        np.savez(path, **{key: self.to_structured()})
+
+    @property
+    def xyz(self):
+        return self.data[:, :3]
+
+    def copy(self):
+        return PointCloud(self.data.copy(), self.fields)
+
+    def transform(self, Tr, inplace=True):
+        """Apply a rigid transform (4 x 4) to the points."""
+        Tr = np.asarray(Tr, dtype=np.float32)
+        assert Tr.shape == (4, 4)
+        cloud = self if inplace else self.copy()
+        xyz = cloud.xyz
+        xyz[...] = xyz @ Tr[:3, :3].T + Tr[:3, 3]
+        return cloud
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.data[:, self.fields.index(item)]
+        if isinstance(item, (list, tuple)) and len(item) > 0 and isinstance(item[0], str):
+            return self.data[:, [self.fields.index(f) for f in item]]
+        # mask or indices of points
+        return PointCloud(self.data[item], self.fields)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return 'PointCloud(%i points, fields=%s)' % (len(self), self.fields)
+
+
+def is_structured(cloud):
+    return isinstance(cloud, np.ndarray) and cloud.dtype.names is not None
+
+
 def position(cloud):
     """Cloud to point positions (xyz)."""
+    if isinstance(cloud, PointCloud):
+        return cloud.xyz
     if cloud.dtype.names:
         x = structured_to_unstructured(cloud[['x', 'y', 'z']])
     else:
@@ -112,7 +225,7 @@ def within_bounds(x, min=None, max=None, bounds=None, log_variable=None):
 
 def filter_range(cloud, min, max, log=False, only_mask=False):
     """Keep points within range interval."""
-    assert isinstance(cloud, np.ndarray), type(cloud)
+    assert isinstance(cloud, (np.ndarray, PointCloud)), type(cloud)
     assert isinstance(min, (float, int)), min
     assert isinstance(max, (float, int)), max
     assert min <= max, (min, max)
@@ -120,7 +233,7 @@ def filter_range(cloud, min, max, log=False, only_mask=False):
     max = float(max)
     if min <= 0.0 and max == np.inf:
         return cloud
-    if cloud.dtype.names:
+    if is_structured(cloud):
         cloud = cloud.ravel()
     x = position(cloud)
     r = np.linalg.norm(x, axis=1)
@@ -137,45 +250,94 @@ def filter_range(cloud, min, max, log=False, only_mask=False):
     return filtered
 
 
+def grid_keys(x, grid_res, bits=21):
+    """Pack integer (x, y, z) cell indices of points into single int64 keys.
+
+    Each axis gets `bits` bits of a signed cell offset, so the keys are consistent
+    across clouds expressed in the same frame (e.g. a global map).
+    The points must have finite coordinates.
+    """
+    assert isinstance(x, np.ndarray) and x.ndim == 2 and x.shape[1] >= 3, x.shape
+    assert isinstance(grid_res, (float, int)) and grid_res > 0.0
+    assert 3 * bits <= 63
+    # NaN and inf cast to int64 give INT64_MIN whose absolute value is negative
+    assert np.isfinite(x[:, :3]).all(), 'Cell keys of points with non-finite coordinates are not defined'
+    cells = np.floor(x[:, :3] / grid_res).astype(np.int64)
+    offset = 1 << (bits - 1)
+    assert np.all(np.abs(cells) < offset), 'Cell indices do not fit into %i bits' % bits
+    cells += offset
+    keys = (cells[:, 0] << (2 * bits)) | (cells[:, 1] << bits) | cells[:, 2]
+    return keys
+
+
 def filter_grid(cloud, grid_res, keep='first', log=False, rng=default_rng, only_mask=False):
-    """Keep single point within each cell. Order is not preserved."""
-    assert isinstance(cloud, np.ndarray), type(cloud)
+    """Keep single point within each cell. Order is not preserved.
+
+    The input cloud is not modified. With keep='centroid' the kept points are moved
+    to the mean position of the points within their cells. Points with non-finite coordinates are removed.
+    """
+    assert isinstance(cloud, (np.ndarray, PointCloud)), type(cloud)
     # assert cloud.dtype.names
     assert isinstance(grid_res, (float, int)) and grid_res > 0.0
-    assert keep in ('first', 'random', 'last')
+    assert keep in ('first', 'random', 'last', 'centroid')
+    assert not (only_mask and keep == 'centroid'), 'Centroids can not be returned as indices'
 
-    if cloud.dtype.names:
+    if is_structured(cloud):
         cloud = cloud.ravel()
-    if keep == 'first':
-        pass
-    elif keep == 'random':
-        rng.shuffle(cloud)
-    elif keep == 'last':
-        cloud = cloud[::-1]
-
     x = position(cloud)
-    keys = np.floor(x / grid_res).astype(int)
-    assert keys.size > 0
-    _, ind = np.unique(keys, return_index=True, axis=0)
+    n_points = len(x)
+    finite = np.isfinite(x[:, :3]).all(axis=1)
+    finite_ind = None
+    if not finite.all():
+        finite_ind = np.flatnonzero(finite)
+        x = x[finite_ind]
+    # empty clouds give empty results
+    keys = grid_keys(x, grid_res)
+
+    if keep == 'random':
+        perm = rng.permutation(len(keys))
+        _, ind = np.unique(keys[perm], return_index=True)
+        ind = perm[ind]
+    elif keep == 'last':
+        _, ind = np.unique(keys[::-1], return_index=True)
+        ind = len(keys) - 1 - ind
+    elif keep == 'centroid':
+        _, ind, inv, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+        inv = inv.ravel()
+        sums = np.stack([np.bincount(inv, weights=x[:, j], minlength=len(ind)) for j in range(3)], axis=1)
+        centroids = sums / counts[:, None]
+    else:
+        _, ind = np.unique(keys, return_index=True)
+    if finite_ind is not None:
+        # indices of the kept points in the input cloud
+        ind = finite_ind[ind]
 
     if log:
         print('%.3f = %i / %i points kept (grid res. %.3f m).'
-              % (len(ind) / len(keys), len(ind), len(keys), grid_res))
+              % (len(ind) / max(n_points, 1), len(ind), n_points, grid_res))
 
     if only_mask:
         return ind
 
     filtered = cloud[ind]
+    if keep == 'centroid':
+        if is_structured(filtered):
+            for j, f in enumerate(['x', 'y', 'z']):
+                filtered[f] = centroids[:, j]
+        elif isinstance(filtered, PointCloud):
+            filtered.xyz[...] = centroids
+        else:
+            filtered[:, :3] = centroids
     return filtered
 
 
 def filter_cylinder(cloud, radius, axis='z', log=False, only_mask=False):
     """Keep points within cylinder."""
-    assert isinstance(cloud, np.ndarray), type(cloud)
+    assert isinstance(cloud, (np.ndarray, PointCloud)), type(cloud)
     assert isinstance(radius, (float, int)) and radius > 0.0
     assert axis in ('x', 'y', 'z')
 
-    if cloud.dtype.names:
+    if is_structured(cloud):
         cloud = cloud.ravel()
     x = position(cloud)
     if axis == 'x':
@@ -200,17 +362,13 @@ def filter_cylinder(cloud, radius, axis='z', log=False, only_mask=False):
 
 def filter_box(cloud, box_size, box_pose=None, only_mask=False):
     """Keep points with rectangular bounds."""
-    assert isinstance(cloud, np.ndarray)
+    assert isinstance(cloud, (np.ndarray, PointCloud))
     assert isinstance(box_size, (tuple, list)) and len(box_size) == 3
     assert all(isinstance(s, (float, int)) and s > 0.0 for s in box_size)
     assert box_pose is None or isinstance(box_pose, np.ndarray)
 
-    if cloud.dtype.names:
-        pts = position(cloud)
-    else:
-        pts = cloud
+    pts = position(cloud)
     assert pts.ndim == 2, "Input points tensor dimensions is %i (only 2 is supported)" % pts.ndim
-    pts = torch.from_numpy(pts)
 
     if box_pose is None:
         box_pose = np.eye(4)
@@ -219,18 +377,9 @@ def filter_box(cloud, box_size, box_pose=None, only_mask=False):
     box_center = box_pose[:3, 3]
     box_orient = box_pose[:3, :3]
 
-    pts = (pts - box_center) @ box_orient
-
-    x = pts[:, 0]
-    y = pts[:, 1]
-    z = pts[:, 2]
+    pts = (pts[:, :3] - box_center) @ box_orient
 
-    keep_x = within_bounds(x, min=-box_size[0] / 2, max=+box_size[0] / 2)
-    keep_y = within_bounds(y, min=-box_size[1] / 2, max=+box_size[1] / 2)
-    keep_z = within_bounds(z, min=-box_size[2] / 2, max=+box_size[2] / 2)
-
-    keep = torch.logical_and(keep_x, keep_y)
-    keep = torch.logical_and(keep, keep_z)
+    keep = np.all(np.abs(pts) <= np.asarray(box_size) / 2, axis=1)
 
     if only_mask:
         return keep
@@ -340,6 +489,71 @@ def estimate_heightmap(points, d_min=1., d_max=6.4, grid_res=0.1,
     return heightmap
 
 
+def rasterize_footprints(poses, length, width, d_max=6.4, grid_res=0.1,
+                         h_max_above_ground=1., robot_clearance=0., fill_value=0., heightmap=None):
+    """
+    Render footprint rectangles of the poses into a heightmap grid.
+
+    A grid cell is covered by a footprint if its center, projected vertically onto the footprint plane,
+    lies within the rectangle. Covered cells get the maximum (z) and minimum (z_min) footprint height
+    over the poses. The grid and the height filtering are the same as in `estimate_heightmap`.
+    Compared to footprint points rasterized by `estimate_heightmap`, the cells at the footprint borders
+    and the heights on slopes (plane height at the cell center instead of at the nearest point) differ.
+    :param poses: footprint poses (N x 4 x 4), footprints are xy-rectangles centered at the pose origins
+    :param length: footprint size along the pose x axis
+    :param width: footprint size along the pose y axis
+    :param heightmap: heightmap (from `estimate_heightmap`) the footprints are rendered into
+    :return: heightmap with x, y, z, z_min and mask grids
+    """
+    poses = np.asarray(poses, dtype=np.float64)
+    assert poses.ndim == 3 and poses.shape[1:] == (4, 4), 'Invalid poses shape %s' % (poses.shape,)
+    assert isinstance(grid_res, (float, int)) and grid_res > 0.
+
+    n = int(2 * d_max / grid_res)
+    xi = np.linspace(-d_max, d_max, n)
+    x_grid, y_grid = np.meshgrid(xi, xi)
+    step = xi[1] - xi[0]
+
+    # heights in the heightmap order (x index first)
+    if heightmap is not None:
+        z = np.where(heightmap['mask'] > 0, heightmap['z'], -np.inf).ravel()
+        z_min = np.where(heightmap['mask'] > 0, heightmap['z'], np.inf).ravel()
+    else:
+        z = np.full(n * n, -np.inf)
+        z_min = np.full(n * n, np.inf)
+    if len(poses) > 0:
+        # candidate cells: a window around each pose containing the footprint circumcircle
+        r = np.hypot(length, width) / 2.
+        k = int(np.ceil(2 * r / step)) + 2
+        lo = np.floor((poses[:, :2, 3] - r + d_max) / step).astype(int)
+        offsets = np.stack(np.meshgrid(np.arange(k), np.arange(k), indexing='ij'), axis=-1).reshape((-1, 2))
+        idx = lo[:, None] + offsets[None]
+        valid = np.all((idx >= 0) & (idx < n), axis=-1)
+        idx = np.clip(idx, 0, n - 1)
+        cells = xi[idx]
+        # footprint plane points: t + a * e_x + b * e_y, solve for (a, b) in the xy plane
+        axes = poses[:, :3, :2]
+        ab = np.einsum('pij,pmj->pmi', np.linalg.inv(axes[:, :2]), cells - poses[:, None, :2, 3])
+        z_fp = poses[:, None, 2, 3] + np.einsum('pj,pmj->pm', axes[:, 2], ab)
+        covered = valid & (np.abs(ab[..., 0]) <= length / 2.) & (np.abs(ab[..., 1]) <= width / 2.)
+        covered &= z_fp + robot_clearance <= h_max_above_ground
+        flat_idx = idx[..., 0][covered] * n + idx[..., 1][covered]
+        np.maximum.at(z, flat_idx, z_fp[covered])
+        np.minimum.at(z_min, flat_idx, z_fp[covered])
+    z = z.reshape((n, n))
+    z_min = z_min.reshape((n, n))
+    mask = np.isfinite(z)
+    z[~mask] = fill_value
+    z_min[~mask] = fill_value
+
+    heightmap = {'x': np.asarray(x_grid, dtype=np.float32),
+                 'y': np.asarray(y_grid, dtype=np.float32),
+                 'z': np.asarray(z, dtype=np.float32),
+                 'z_min': np.asarray(z_min, dtype=np.float32),
+                 'mask': mask.astype(np.float32)}
+    return heightmap
+
+
 def hm_to_cloud(height, cfg, mask=None):
     assert isinstance(height, np.ndarray) or isinstance(height, torch.Tensor)
     assert height.ndim == 2
@@ -425,6 +639,72 @@ def points2range_img(x, y, z,
     return depth_img
 
 
+def segment_ground(points, max_slope=np.pi / 12., max_ground_height=None, return_height=False):
+    """
+    Ground and obstacle segmentation of an organized (range image) point cloud.
+
+    Every column of the range image is traversed from the lowest to the highest laser beam.
+    A point belongs to the ground as long as the slopes between all consecutive valid points
+    of its column, starting from the lowest one, are below `max_slope`. The remaining valid points
+    are obstacles.
+
+    @param points: organized points (H x W x 3), rows correspond to laser beams.
+    @param max_slope: maximal terrain inclination between consecutive beams [rad].
+    @param max_ground_height: maximal height of the lowest ground point of a column.
+    @param return_height: return also heights of the points above the ground of their column.
+    @return: ground mask (H x W), obstacle mask (H x W)[, heights above ground (H x W)].
+
+    Example:
+    ```
+    cloud = ds.get_raw_cloud(i, organized=True)
+    points = position(cloud.ravel()).reshape(cloud.shape + (3,))
+    ground, obstacle = segment_ground(points)
+    ```
+    """
+    assert isinstance(points, np.ndarray)
+    assert points.ndim == 3 and points.shape[2] >= 3, 'Organized cloud (H x W x 3) expected, got %s' % (points.shape,)
+    assert max_slope > 0.
+    H, W = points.shape[:2]
+    xyz = points[..., :3]
+    valid = np.isfinite(xyz).all(axis=2) & (xyz != 0.).any(axis=2)
+    xyz = np.where(valid[..., None], xyz, 0.)
+    r = np.hypot(xyz[..., 0], xyz[..., 1])
+    z = xyz[..., 2]
+
+    # order beams from the lowest to the highest elevation
+    elev = np.where(valid, np.arctan2(z, r), 0.)
+    elev = elev.sum(axis=1) / np.maximum(valid.sum(axis=1), 1)
+    order = np.argsort(elev)
+    r, z, valid = r[order], z[order], valid[order]
+
+    # previous valid point in the column
+    rows = np.arange(H)[:, None]
+    cols = np.arange(W)[None, :]
+    last_valid = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    prev = np.concatenate([np.full((1, W), -1), last_valid[:-1]], axis=0)
+    prev_i = np.maximum(prev, 0)
+
+    slope = np.arctan2(np.abs(z - z[prev_i, cols]), np.abs(r - r[prev_i, cols]))
+    if max_ground_height is None:
+        start_ok = np.ones_like(valid)
+    else:
+        start_ok = z <= max_ground_height
+    ok = np.where(prev >= 0, slope <= max_slope, start_ok)
+    # invalid points do not interrupt the ground
+    ok |= ~valid
+    ground = np.logical_and.accumulate(ok, axis=0) & valid
+    obstacle = valid & ~ground
+
+    inv_order = np.argsort(order)
+    if return_height:
+        last_ground = np.maximum.accumulate(np.where(ground, rows, -1), axis=0)
+        z_ground = np.where(last_ground >= 0, z[np.maximum(last_ground, 0), cols], np.nan)
+        height = np.where(valid, z - z_ground, np.nan)
+        return ground[inv_order], obstacle[inv_order], height[inv_order]
+
+    return ground[inv_order], obstacle[inv_order]
+
+
 def merge_heightmaps(new_points, prev_points, grid_res=None):
     """
     Ones new cloud is received, find the overlapping region with the existing cloud and merge them
@@ -458,3 +738,120 @@ def merge_heightmaps(new_points, prev_points, grid_res=None):
     prev_points = np.column_stack((X, Y, Z))
 
     return prev_points
+
+
+class VoxelMap:
+    """
+    Point map accumulated from multiple clouds keeping a single point per voxel.
+
+    Added clouds are kept in pending chunks and deduplicated against the whole map
+    with packed voxel keys once the pending part grows as large as the map itself.
+    The map is therefore not re-copied for every added cloud.
+    """
+
+    def __init__(self, grid_res, chunk_size=1_000_000):
+        assert isinstance(grid_res, (float, int)) and grid_res > 0.
+        assert isinstance(chunk_size, int) and chunk_size > 0
+        self.grid_res = grid_res
+        self.chunk_size = chunk_size
+        self.points = np.zeros((0, 3), dtype=np.float32)
+        self.keys = np.zeros((0,), dtype=np.int64)
+        self.pending_points = []
+        self.pending_keys = []
+        self.n_pending = 0
+
+    def add(self, points):
+        """Add points (N x 3) expressed in the map frame."""
+        assert points.ndim == 2 and points.shape[1] >= 3, 'Invalid cloud shape %s' % (points.shape,)
+        points = np.asarray(points[:, :3], dtype=np.float32)
+        points = points[np.isfinite(points).all(axis=1)]
+        if len(points) == 0:
+            return
+        keys, ind = np.unique(grid_keys(points, self.grid_res), return_index=True)
+        self.push(points[ind], keys)
+
+    def update(self, other):
+        """Add all points of another voxel map with the same resolution."""
+        assert isinstance(other, VoxelMap)
+        assert other.grid_res == self.grid_res
+        other.merge()
+        if len(other) > 0:
+            self.push(other.points, other.keys)
+
+    def push(self, points, keys):
+        self.pending_points.append(points)
+        self.pending_keys.append(keys)
+        self.n_pending += len(keys)
+        if self.n_pending >= max(self.chunk_size, len(self.keys)):
+            self.merge()
+
+    def merge(self):
+        """Deduplicate pending points against the map."""
+        if self.n_pending == 0:
+            return
+        keys = np.concatenate([self.keys] + self.pending_keys)
+        points = np.concatenate([self.points] + self.pending_points)
+        _, ind = np.unique(keys, return_index=True)
+        # keep the points in the order they were added
+        ind.sort()
+        self.keys = keys[ind]
+        self.points = points[ind]
+        self.pending_points = []
+        self.pending_keys = []
+        self.n_pending = 0
+
+    def get_points(self):
+        self.merge()
+        return self.points
+
+    def __len__(self):
+        return len(self.keys) + self.n_pending
+
+
+def voxel_map_from_clouds(get_points, ids, grid_res):
+    voxel_map = VoxelMap(grid_res)
+    for i in ids:
+        voxel_map.add(get_points(i))
+    voxel_map.merge()
+    return voxel_map
+
+
+def build_voxel_map(get_points, ids, grid_res, n_workers=0, frames_per_chunk=50):
+    """
+    Build a voxel map from clouds.
+
+    @param get_points: callable returning points (N x 3) in the map frame for a frame id,
+                       it has to be picklable if n_workers > 0.
+    @param ids: frame ids (or indices) passed to get_points.
+    @param grid_res: voxel size.
+    @param n_workers: number of worker processes, each building a map of a chunk of frames.
+    @param frames_per_chunk: number of frames processed by a worker at once.
+    @return: VoxelMap.
+    """
+    assert isinstance(n_workers, int) and n_workers >= 0
+    voxel_map = VoxelMap(grid_res)
+    if n_workers == 0:
+        for i in tqdm(ids):
+            voxel_map.add(get_points(i))
+    else:
+        chunks = [ids[i:i + frames_per_chunk] for i in range(0, len(ids), frames_per_chunk)]
+        build_chunk = partial(voxel_map_from_clouds, get_points, grid_res=grid_res)
+        with Pool(n_workers) as pool:
+            for chunk_map in tqdm(pool.imap(build_chunk, chunks), total=len(chunks)):
+                voxel_map.update(chunk_map)
+    voxel_map.merge()
+    return voxel_map
+
+
+def save_points(path, points):
+    """Save points (N x C) to a .npy file which can be memory-mapped by load_points."""
+    assert path.endswith('.npy'), path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, np.ascontiguousarray(points, dtype=np.float32))
+    os.replace(tmp_path, path)
+
+
+def load_points(path, mmap=True):
+    """Load points saved with save_points, memory-mapped (read-only) by default."""
+    return np.load(path, mmap_mode='r' if mmap else None)
@@ -1,3 +1,7 @@
 from __future__ import absolute_import, division, print_function
 from .robingas import *
 from .rellis3d import *
+from .bags import *
+from .sample import *
+from .collate import *
+from .samplers import *
@@ -0,0 +1,258 @@
+import io
+import os
+from collections import deque
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from PIL import Image
+from ..config import DPhysConfig
+from ..utils import position, load_calib
+from ..transformations import poses_to_states
+from .robingas import RobinGas
+
+
+__all__ = [
+    'RobinGasBag',
+]
+
+
+def joint_state_track_vels(msg):
+    """Left and right track velocities from a sensor_msgs/JointState message."""
+    return np.asarray(msg.velocity[:2], dtype=np.float32)
+
+
+class RobinGasBag(IterableDataset, RobinGas):
+    """
+    Iterable dataset streaming RobinGas samples directly from ROS bag files.
+
+    Lidar clouds define the samples. The messages are read in time order and the frames are kept in
+    a window until the stream covers their trajectory horizon (`traj_sim_time`): the future poses
+    (looked up from tf) and track velocities. Then the sample of the oldest frame is built
+    with the synchronized camera images and emitted as the same tuple (or Sample) as `RobinGas.get_sample`.
+    Only the images and the cloud of the emitted frames are decoded.
+
+    Calibration is read from a RobinGas calibration directory (cameras and transformations).
+    Height maps are estimated on the fly, terrain height maps are estimated from the trajectory
+    footprint only (SAM segmentations are not available in bags).
+    DataLoader workers stream the same bags and emit disjoint subsets of the samples.
+
+    Example:
+    ```
+    ds = RobinGasBag(['ugv_2024-09-10-17-02-31_0.bag', 'ugv_2024-09-10-17-02-31_1.bag'],
+                     calib_path='calibration', lss_cfg=lss_cfg, dphys_cfg=dphys_cfg)
+    loader = DataLoader(ds, batch_size=4, num_workers=4)
+    ```
+    """
+
+    def __init__(self,
+                 bag_paths,
+                 calib_path,
+                 lss_cfg,
+                 dphys_cfg=DPhysConfig(),
+                 is_train=False,
+                 only_front_cam=False,
+                 gpu_img_aug=False,
+                 n_img_threads=4,
+                 cloud_topic='/os_cloud_node/points',
+                 camera_topics=None,
+                 control_topic='/marv/tracks/joint_states',
+                 controls_from_msg=joint_state_track_vels,
+                 world_frame='odom',
+                 robot_frame='base_link',
+                 max_img_delay=0.1,
+                 fields=None):
+        """
+        :param bag_paths: bag files of one recording in time order (e.g. split bags)
+        :param calib_path: RobinGas calibration directory
+        :param camera_topics: dict camera name -> image topic (sensor_msgs/Image or CompressedImage),
+                              by default /<camera>/image_color/compressed for the calibrated cameras
+        :param controls_from_msg: function returning track velocities (2) of a control message
+        :param world_frame: fixed frame of the robot poses
+        :param max_img_delay: maximal time difference between a cloud and the images of a sample [s]
+        :param fields: names of the sample fields emitted as a Sample, all fields as a tuple by default
+        """
+        self.bag_paths = [bag_paths] if isinstance(bag_paths, str) else list(bag_paths)
+        for bag_path in self.bag_paths:
+            assert os.path.exists(bag_path), f'Bag file {bag_path} does not exist'
+        self.path = os.path.dirname(self.bag_paths[0])
+        self.name = os.path.basename(self.bag_paths[0])
+        self.calib_path = calib_path
+        self.calib = load_calib(calib_path=calib_path)
+        self.dphys_cfg = dphys_cfg
+        cams = sorted(cam.replace('.yaml', '') for cam in os.listdir(os.path.join(calib_path, 'cameras')))
+        if 'camera_up' in cams:
+            cams.remove('camera_up')
+        self.camera_names = cams
+        # streamed clouds are not compiled into a cloud store
+        self.cloud_store_path = None
+
+        # window of frames the current sample is built from
+        self.ids = np.zeros(0, dtype=str)
+        self.ts = self.seq_ts = np.zeros(0)
+        self.poses = self.seq_poses = np.zeros((0, 4, 4))
+        self.seq_vels = (np.zeros((0, 3)), np.zeros((0, 3)))
+        self.frames = np.zeros(0, dtype=int)
+        self.init_caches()
+        # SAM segmentations are not available in bags
+        self.init_samples(lss_cfg, is_train=is_train, only_front_cam=only_front_cam, use_rigid_semantics=False,
+                          gpu_img_aug=gpu_img_aug, n_img_threads=n_img_threads, fields=fields)
+
+        if camera_topics is None:
+            camera_topics = {cam: f'/{cam}/image_color/compressed' for cam in self.camera_names}
+        assert set(self.camera_names) <= set(camera_topics.keys()), 'Image topics of all cameras are required'
+        self.camera_topics = camera_topics
+        self.cloud_topic = cloud_topic
+        self.control_topic = control_topic
+        self.controls_from_msg = controls_from_msg
+        self.world_frame = world_frame
+        self.robot_frame = robot_frame
+        self.max_img_delay = max_img_delay
+        self.window_clouds = []
+        self.window_imgs = {}
+
+    def get_controls(self):
+        return self.controls
+
+    def get_reduced_img_size(self):
+        # images are decoded from the messages
+        return None
+
+    def get_raw_cloud(self, i, organized=False):
+        from ros_numpy import numpify
+        cloud = numpify(self.window_clouds[i])
+        if cloud.ndim == 2 and not organized:
+            cloud = cloud.reshape((-1,))
+        return cloud
+
+    def get_raw_image(self, i, camera=None, size=None):
+        # images are kept for the emitted (first) frame of the window only
+        assert i == 0, 'Images are available only for the current sample'
+        if camera is None:
+            camera = self.camera_names[0]
+        msg = self.window_imgs[camera]
+        if hasattr(msg, 'format'):
+            img = Image.open(io.BytesIO(msg.data))
+            if size is not None:
+                img.draft('RGB', tuple(size))
+            return img
+        from ros_numpy import numpify
+        img = numpify(msg)
+        if msg.encoding.startswith('bgr'):
+            img = img[..., 2::-1]
+        return Image.fromarray(np.ascontiguousarray(img))
+
+    def get_geom_height_map(self, i, points_source='lidar', **kwargs):
+        assert points_source == 'lidar', 'Only lidar clouds are streamed'
+        points = position(self.get_cloud(i))
+        hm = self.estimate_heightmap(points, **kwargs)
+        return torch.from_numpy(np.stack([hm['z'], hm['mask']]).astype(np.float32))
+
+    def get_terrain_height_map(self, i, **kwargs):
+        hm = self.get_footprint_traj_height_map(i)
+        return torch.from_numpy(np.stack([hm['z'], hm['mask']]).astype(np.float32))
+
+    def set_window(self, frames, controls, imgs):
+        self.ts = self.seq_ts = np.asarray([f['stamp'] for f in frames])
+        self.poses = self.seq_poses = np.stack([f['pose'] for f in frames]).astype(np.float32)
+        self.frames = np.arange(len(frames))
+        _, xds, _, omegas = poses_to_states(self.seq_poses, self.seq_ts)
+        self.seq_vels = (xds, omegas)
+        self.ids = np.asarray(['%.9f' % f['stamp'] for f in frames])
+        self.window_clouds = [f['cloud'] for f in frames]
+        self.window_imgs = imgs
+        if len(controls) > 0:
+            stamps, vels = zip(*controls)
+            self.controls = (np.asarray(stamps), np.stack(vels))
+        else:
+            self.controls = None
+
+    def lookup_pose(self, tf_buffer, stamp):
+        import rospy
+        import tf2_ros
+        from ros_numpy import numpify
+        try:
+            tf = tf_buffer.lookup_transform(self.world_frame, self.robot_frame, rospy.Time.from_sec(stamp))
+        except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException) as e:
+            print(f'Pose of {self.robot_frame} at {stamp:.3f} is not available: {e}')
+            return None
+        return numpify(tf.transform)
+
+    def __iter__(self):
+        import rosbag
+        import rospy
+        import tf2_ros
+
+        worker = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        T_horizon = self.dphys_cfg.traj_sim_time
+        tf_buffer = tf2_ros.Buffer(cache_time=rospy.Duration(4 * T_horizon + 60.))
+        cam_of_topic = {topic: cam for cam, topic in self.camera_topics.items() if cam in self.camera_names}
+        topics = [self.cloud_topic, self.control_topic, '/tf', '/tf_static'] + list(cam_of_topic.keys())
+
+        frames = deque()
+        imgs = {cam: deque() for cam in self.camera_names}
+        controls = deque()
+        n_frames = 0
+
+        def emit(end=False):
+            # emit the oldest frames whose trajectory horizon is covered by the stream
+            nonlocal n_frames
+            while frames and (end or stream_time > frames[0]['stamp'] + T_horizon + self.max_img_delay):
+                frame = frames.popleft()
+                k = n_frames
+                n_frames += 1
+                if k % n_workers != worker_id:
+                    continue
+                window = [frame] + [f for f in frames if f['stamp'] <= frame['stamp'] + T_horizon]
+                for f in window:
+                    if 'pose' not in f:
+                        f['pose'] = self.lookup_pose(tf_buffer, f['stamp'])
+                if frame['pose'] is None:
+                    continue
+                window = [frame] + [f for f in window[1:] if f['pose'] is not None]
+                # synchronized images
+                frame_imgs = {}
+                for cam, msgs in imgs.items():
+                    if len(msgs) == 0:
+                        break
+                    dts = [abs(m.header.stamp.to_sec() - frame['stamp']) for m in msgs]
+                    if min(dts) > self.max_img_delay:
+                        break
+                    frame_imgs[cam] = msgs[int(np.argmin(dts))]
+                if len(frame_imgs) < len(imgs):
+                    print(f'Frame at {frame["stamp"]:.3f} has no synchronized images of all cameras, skipping')
+                    continue
+                self.set_window(window, controls, frame_imgs)
+                yield self.get_sample(0)
+            # release messages not needed by the remaining frames, or by the frames still to arrive
+            # (assuming clouds lag the stream by less than the horizon) if there are none
+            t_min = frames[0]['stamp'] if frames else stream_time - T_horizon
+            for msgs in imgs.values():
+                while msgs and msgs[0].header.stamp.to_sec() < t_min - self.max_img_delay:
+                    msgs.popleft()
+            while len(controls) > 1 and controls[1][0] < t_min:
+                controls.popleft()
+
+        stream_time = -np.inf
+        for bag_path in self.bag_paths:
+            with rosbag.Bag(bag_path, 'r') as bag:
+                for topic, msg, t in bag.read_messages(topics=topics):
+                    stream_time = t.to_sec()
+                    if topic == '/tf_static':
+                        for tf in msg.transforms:
+                            tf_buffer.set_transform_static(tf, 'bag')
+                    elif topic == '/tf':
+                        for tf in msg.transforms:
+                            tf_buffer.set_transform(tf, 'bag')
+                    elif topic == self.cloud_topic:
+                        frames.append({'stamp': msg.header.stamp.to_sec(), 'cloud': msg})
+                    elif topic in cam_of_topic:
+                        imgs[cam_of_topic[topic]].append(msg)
+                    elif topic == self.control_topic:
+                        stamp = msg.header.stamp.to_sec() if hasattr(msg, 'header') else stream_time
+                        controls.append((stamp, self.controls_from_msg(msg)))
+                    yield from emit()
+        yield from emit(end=True)
+
+    def __len__(self):
+        raise TypeError('Number of samples streamed from bags is not known in advance')
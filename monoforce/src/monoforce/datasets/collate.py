@@ -0,0 +1,47 @@
+import torch
+from torch.utils.data import default_collate
+from .sample import Sample
+
+
+__all__ = [
+    'collate_points',
+]
+
+
+def collate_points(batch):
+    """
+    Collate samples whose last field is a point cloud (3 x N) of variable size,
+    for example, samples of RobinGasPoints or Rellis3DPoints.
+
+    The clouds are zero-padded to the largest cloud of the batch and their lengths are appended,
+    the batch thus ends with points (B x 3 x N_max) and lengths (B). The other fields are collated
+    with the default collate, which keeps their dtypes (e.g. uint8 images).
+    Samples with named fields (Sample) are collated into a Sample with padded `points`
+    and `points_lengths` fields.
+    The returned tensors can be pinned by the DataLoader (`pin_memory=True`) and copied to the device
+    with `non_blocking=True`.
+
+    Example:
+    ```
+    loader = DataLoader(ds, batch_size=4, collate_fn=collate_points, pin_memory=True)
+    for batch in loader:
+        batch = [b.to(device, non_blocking=True) for b in batch]
+        points, lengths = batch[-2:]
+    ```
+    """
+    if isinstance(batch[0], Sample):
+        fields = default_collate([Sample((k, v) for k, v in sample.items() if k != 'points') for sample in batch])
+        fields['points'], fields['points_lengths'] = pad_clouds([sample['points'] for sample in batch])
+        return fields
+    fields = default_collate([sample[:-1] for sample in batch])
+    points, lengths = pad_clouds([sample[-1] for sample in batch])
+    return list(fields) + [points, lengths]
+
+
+def pad_clouds(clouds):
+    clouds = [torch.as_tensor(cloud) for cloud in clouds]
+    lengths = torch.as_tensor([cloud.shape[-1] for cloud in clouds], dtype=torch.int64)
+    points = clouds[0].new_zeros((len(clouds),) + tuple(clouds[0].shape[:-1]) + (int(lengths.max()),))
+    for k, cloud in enumerate(clouds):
+        points[k, ..., :cloud.shape[-1]] = cloud
+    return points, lengths
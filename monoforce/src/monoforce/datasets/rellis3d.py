@@ -3,12 +3,15 @@ import os
 import numpy as np
 from matplotlib import pyplot as plt
 from ..models.terrain_encoder.utils import img_transform, normalize_img, sample_augmentation
-from ..utils import position, read_yaml, timing
-from ..transformations import transform_cloud
-from ..cloudproc import filter_grid, estimate_heightmap
+from ..utils import position, read_yaml, timing, mtimes
+from ..transformations import transform_cloud, transform_clouds, poses_to_states
+from ..cloudproc import PointCloud, filter_grid, estimate_heightmap, rasterize_footprints, build_voxel_map
 from ..config import DPhysConfig
 from .robingas import data_dir
+from .storage import TerrainStore
+from .sample import Sample, IMG_FIELDS
 from copy import copy
+from functools import partial
 import torch
 import yaml
 from PIL import Image
@@ -16,7 +19,6 @@ from numpy.lib.recfunctions import unstructured_to_structured
 from scipy.spatial.transform import Rotation
 import open3d as o3d
 from tqdm import tqdm
-from scipy.spatial import cKDTree
 import albumentations as A
 
 
@@ -138,6 +140,10 @@ def read_extrinsics(path, key='os1_cloud_node-pylon_camera_node'):
 
 
 class Rellis3DBase(torch.utils.data.Dataset):
+    # sequence metadata (calibration, poses, ids, stamps) shared by all datasets of the same path,
+    # reloaded when the sequence files change
+    seq_data = {}
+
     def __init__(self, path):
         """Rellis-3D dataset: https://unmannedlab.github.io/research/RELLIS-3D.
 
@@ -145,11 +151,36 @@ class Rellis3DBase(torch.utils.data.Dataset):
         """
         self.path = path
         self.seq = os.path.basename(path)
-        self.calib = self.get_calibration()
-        self.poses = self.get_poses()
-        self.ids_lid, self.ts_lid = self.get_ids(sensor='lidar')
-        self.ids_rgb, self.ts_rgb = self.get_ids(sensor='rgb')
+        seq_key = os.path.realpath(path)
+        stamp = self.get_seq_stamp()
+        if Rellis3DBase.seq_data.get(seq_key, (None,))[0] != stamp:
+            self.calib = self.get_calibration()
+            poses = self.get_poses()
+            ids_lid, ts_lid = self.get_ids(sensor='lidar')
+            # velocities of the robot along the whole sequence
+            _, xds, _, omegas = poses_to_states(poses, ts_lid)
+            Rellis3DBase.seq_data[seq_key] = (stamp, (self.calib, poses, (xds, omegas), (ids_lid, ts_lid),
+                                                      self.get_ids(sensor='rgb')))
+        (self.calib, self.poses, self.seq_vels,
+         (self.ids_lid, self.ts_lid), (self.ids_rgb, self.ts_rgb)) = Rellis3DBase.seq_data[seq_key][1]
+        # sequence index of a lidar id
+        self.lid_index = {id: i for i, id in enumerate(self.ids_lid)}
         self.ids = self.ids_lid
+        self.terrain_stores = {}
+
+    def get_seq_stamp(self):
+        """Modification times of the files the sequence metadata is read from."""
+        return mtimes([os.path.join(self.path, 'os1_cloud_node_color_ply'),
+                       os.path.join(self.path, 'pylon_camera_node'),
+                       self.cloud_poses_path(), self.intrinsics_path(), self.lidar2cam_path(), self.robot2lidar_path()])
+
+    @classmethod
+    def clear_seq_data(cls, path=None):
+        """Drop the shared metadata of a sequence (all sequences by default), it is loaded again by new datasets."""
+        if path is None:
+            Rellis3DBase.seq_data.clear()
+        else:
+            Rellis3DBase.seq_data.pop(os.path.realpath(path), None)
 
     def get_calibration(self):
         P = np.zeros([3, 4])
@@ -178,7 +209,7 @@ class Rellis3DBase(torch.utils.data.Dataset):
         ids = [f[:-4] for f in np.sort(os.listdir(os.path.join(self.path, sensor_folder)))]
         ts = [float('%.3f' % (float(id.split('-')[1].split('_')[0]) + float(id.split('-')[1].split('_')[1]) / 1000.0))
               for id in ids]
-        ts = np.sort(ts).tolist()
+        ts = np.sort(ts)
         return ids, ts
 
     def get_poses(self):
@@ -193,11 +224,11 @@ class Rellis3DBase(torch.utils.data.Dataset):
         if filetype == '.ply':
             return os.path.join(self.path, 'os1_cloud_node_color_ply', '%s.ply' % id)
         else:
-            return os.path.join(self.path, 'os1_cloud_node_kitti_bin', '%06d.bin' % self.ids_lid.index(id))
+            return os.path.join(self.path, 'os1_cloud_node_kitti_bin', '%06d.bin' % self.lid_index[id])
 
     def cloud_label_path(self, id):
         return os.path.join(self.path, 'os1_cloud_node_semantickitti_label_id',
-                            '%06d.label' % self.ids_lid.index(id))
+                            '%06d.label' % self.lid_index[id])
 
     def cloud_poses_path(self):
         return os.path.join(self.path, 'poses.txt')
@@ -245,14 +276,14 @@ class Rellis3DBase(torch.utils.data.Dataset):
             yield self[i]
 
     def get_cloud(self, id_lid):
-        assert id_lid in self.ids_lid
-        cloud = read_points(self.lidar_cloud_path(id_lid))
+        assert id_lid in self.lid_index
+        cloud = PointCloud.from_structured(read_points(self.lidar_cloud_path(id_lid)))
         # transform to robot frame
-        cloud = transform_cloud(cloud, self.calib['robot2lidar'])
+        cloud.transform(self.calib['robot2lidar'])
         return cloud
 
     def cloud_label(self, id_lid):
-        assert id_lid in self.ids_lid
+        assert id_lid in self.lid_index
         return read_points_labels(self.cloud_label_path(id_lid))
 
     def get_cloud_pose(self, id):
@@ -262,8 +293,22 @@ class Rellis3DBase(torch.utils.data.Dataset):
         pose = self.poses[i]
         return pose
 
+    def get_map_points(self, id, grid_res=None):
+        # lidar points in the map frame
+        points = position(self.get_cloud(id))
+        if grid_res is not None:
+            points = filter_grid(points, grid_res=grid_res)
+        points = transform_cloud(points, self.get_cloud_pose(id))
+        return points
+
+    def get_global_cloud(self, grid_res=0.5, step=100, n_workers=0):
+        ids = self.ids[::step]
+        voxel_map = build_voxel_map(partial(self.get_map_points, grid_res=grid_res), ids, grid_res,
+                                    n_workers=n_workers)
+        return voxel_map.get_points()
+
     def get_image(self, id):
-        assert id in self.ids  # these are lidar ids
+        assert id in self.lid_index  # these are lidar ids
         t = float(id.split('-')[1].split('_')[0]) + float(id.split('-')[1].split('_')[1]) / 1000.0
         i = np.searchsorted(self.ts_rgb, t)
         i = np.clip(i, 0, len(self.ids_rgb) - 1)
@@ -272,14 +317,22 @@ class Rellis3DBase(torch.utils.data.Dataset):
     def get_raw_img_size(self, id=None):
         if id is None:
             id = self.ids[0]
-        assert id in self.ids
+        assert id in self.lid_index
         img = self.get_image(id)
         return img.shape[0], img.shape[1]
 
 
 class Rellis3D(Rellis3DBase):
-    def __init__(self, path, lss_cfg, dphys_cfg=DPhysConfig(), is_train=False, only_front_hm=False):
+    # names of the sample fields in the order of the sample tuple
+    sample_fields = IMG_FIELDS + ('hm_geom', 'hm_terrain')
+
+    def __init__(self, path, lss_cfg, dphys_cfg=DPhysConfig(), is_train=False, only_front_hm=False, fields=None):
         super().__init__(path)
+        if fields is not None:
+            unknown = set(fields) - set(self.sample_fields)
+            assert not unknown, f'Unknown sample fields {unknown}, available fields are {self.sample_fields}'
+        # names of the fields of a Sample, all fields as a tuple by default
+        self.fields = fields
         self.dphys_cfg = dphys_cfg
         self.is_train = is_train
         self.lss_cfg = lss_cfg
@@ -306,60 +359,54 @@ class Rellis3D(Rellis3DBase):
         else:
             return None
 
+    def get_traj_frames(self, id, n_frames=100):
+        """Sequence frames (n_frames) of the trajectory starting at the sample and their time stamps."""
+        i0 = self.lid_index[id]
+        frames = np.arange(i0, min(i0 + n_frames, len(self.ids_lid)))
+        stamps = np.asarray(self.ts_lid[frames])
+
+        # make sure the trajectory has the fixed length
+        if len(frames) < n_frames:
+            # repeat the last pose to fill the trajectory
+            n_pad = n_frames - len(frames)
+            frames = np.concatenate([frames, np.full(n_pad, frames[-1])])
+            dt = np.mean(np.diff(stamps)) if len(stamps) > 1 else np.mean(np.diff(self.ts_lid))
+            stamps = np.concatenate([stamps, stamps[-1] + np.arange(1, n_pad + 1) * dt], axis=0)
+        return frames, stamps
+
     def get_traj(self, id, n_frames=100):
-        i0 = self.ids.index(id)
-        i1 = i0 + n_frames
-        i1 = np.clip(i1, 0, len(self.ids))
-        poses = copy(self.poses[i0:i1])
+        frames, stamps = self.get_traj_frames(id, n_frames=n_frames)
+        poses = self.poses[frames]
         # transform to robot frame
         poses = np.linalg.inv(poses[0]) @ poses
         # take into account robot's clearance
         poses[:, 2, 3] -= self.calib['clearance']
         footprint_poses = poses
-        # time stamps
-        stamps = np.asarray(copy(self.ts_lid[i0:i1]))
         traj = {'poses': footprint_poses, 'stamps': stamps}
         return traj
 
-    def get_states_traj(self, id, start_from_zero=False):
-        traj = self.get_traj(id)
-        poses = traj['poses']
-
-        if start_from_zero:
-            # transform poses to the same coordinate frame as the height map
-            Tr = np.linalg.inv(poses[0])
-            poses = np.asarray([np.matmul(Tr, p) for p in poses])
-            poses[:, 2, 3] -= self.calib['clearance']
-            # count time from 0
-            tstamps = traj['stamps']
-            tstamps = tstamps - tstamps[0]
-
-        poses = np.asarray(poses, dtype=np.float32)
-        tstamps = np.asarray(tstamps, dtype=np.float32)
-
-        xyz = torch.as_tensor(poses[:, :3, 3])
-        rot = torch.as_tensor(poses[:, :3, :3])
-
-        n_states = len(xyz)
-        tt = torch.tensor(tstamps)[None].T
-
-        dps = torch.diff(xyz, dim=0)
-        dt = torch.diff(tt, dim=0)
-        theta = torch.atan2(dps[:, 1], dps[:, 0]).view(-1, 1)
-        theta = torch.cat([theta[:1], theta], dim=0)
-
-        vel = torch.zeros_like(xyz)
-        vel[:-1] = dps / dt
-        omega = torch.zeros_like(xyz)
-        omega[:-1, 2:3] = torch.diff(theta, dim=0) / dt  # + torch.diff(angles, dim=0)[:, 2:3] / dt
-
-        forces = torch.zeros((n_states, 3, 10))
-        states = (xyz.view(n_states, 3, 1),
-                  rot.view(n_states, 3, 3),
-                  vel.view(n_states, 3, 1),
-                  omega.view(n_states, 3, 1),
-                  forces.view(n_states, 3, 10))
-        return states
+    def get_states_traj(self, id):
+        """
+        Trajectory time stamps and states (positions, velocities, rotations, angular velocities)
+        in the robot frame, velocities are taken from the precomputed sequence velocities.
+        """
+        frames, stamps = self.get_traj_frames(id)
+        poses = self.get_traj(id)['poses']
+
+        # transform velocities to the robot frame of the first pose
+        R = self.poses[frames[0]][:3, :3]
+        xds, omegas = self.seq_vels
+        xds = xds[frames] @ R
+        omegas = omegas[frames] @ R
+        # the robot stands at the repeated last pose
+        repeated = np.concatenate([[False], frames[1:] == frames[:-1]])
+        xds[repeated] = 0.
+        omegas[repeated] = 0.
+        # count time from 0
+        ts = stamps - stamps[0]
+
+        states = (poses[:, :3, 3], xds, poses[:, :3, :3], omegas)
+        return ts, states
 
     def get_footprint_traj_points(self, id, robot_size=(1.38, 1.52)):
         traj = self.get_traj(id)
@@ -376,19 +423,42 @@ class Rellis3D(Rellis3DBase):
         Tr_base_link__base_footprint = np.eye(4)
         Tr_base_link__base_footprint[0, 3] = -self.calib['clearance']
 
-        trajectory_footprint = None
-        for pose in poses:
-            Tr = pose @ Tr_base_link__base_footprint
-            footprint = transform_cloud(footprint0, Tr)
-            if trajectory_footprint is None:
-                trajectory_footprint = footprint
-            else:
-                tree = cKDTree(trajectory_footprint)
-                d, _ = tree.query(footprint)
-                footprint = footprint[d > self.dphys_cfg.grid_res]
-                trajectory_footprint = np.concatenate([trajectory_footprint, footprint], axis=0)
+        # footprints of all poses, overlapping points are reduced to one per grid cell
+        trajectory_footprint = transform_clouds(poses @ Tr_base_link__base_footprint, footprint0).reshape((-1, 3))
+        trajectory_footprint = filter_grid(trajectory_footprint, grid_res=self.dphys_cfg.grid_res, keep='first')
         return trajectory_footprint
 
+    def get_footprint_traj_height_map(self, id, obstacle_points=None, robot_size=(1.38, 1.52)):
+        """
+        Height map of the robot footprint swept along the trajectory and optional obstacle points.
+        The footprint rectangles are rendered directly into the grid, interpolated height maps
+        (`hm_interp_method` is set) are estimated from the footprint points.
+        """
+        if self.dphys_cfg.hm_interp_method is not None:
+            points = self.get_footprint_traj_points(id, robot_size=robot_size)
+            if obstacle_points is not None:
+                points = np.concatenate([points, obstacle_points], axis=0)
+            return self.estimate_heightmap(points, robot_radius=None)
+
+        hm_obstacles = None
+        if obstacle_points is not None and len(obstacle_points) > 0:
+            hm_obstacles = self.estimate_heightmap(obstacle_points, robot_radius=None)
+        width, length = robot_size
+        Tr_base_link__base_footprint = np.eye(4)
+        Tr_base_link__base_footprint[0, 3] = -self.calib['clearance']
+        poses_footprint = self.get_traj(id)['poses'] @ Tr_base_link__base_footprint
+        height = rasterize_footprints(poses_footprint, length=length, width=width,
+                                      d_max=self.dphys_cfg.d_max, grid_res=self.dphys_cfg.grid_res,
+                                      h_max_above_ground=self.dphys_cfg.h_max_above_ground, heightmap=hm_obstacles)
+        return height
+
+    def get_terrain_store(self, dir_name, name='store'):
+        # one height map store per sequence and terrain type, indexed by all lidar ids
+        path = os.path.join(dir_name, name)
+        if path not in self.terrain_stores:
+            self.terrain_stores[path] = TerrainStore(path, ids=self.ids_lid)
+        return self.terrain_stores[path]
+
     def estimate_heightmap(self, points, **kwargs):
         # estimate heightmap from point cloud
         height = estimate_heightmap(points, d_min=self.dphys_cfg.d_min, d_max=self.dphys_cfg.d_max,
@@ -407,18 +477,21 @@ class Rellis3D(Rellis3DBase):
         """
         if dir_name is None:
             dir_name = os.path.join(self.path, 'terrain', 'lidar')
-        file_path = os.path.join(dir_name, '%05d.npy' % self.ids.index(id))
-        if cached and os.path.exists(file_path):
-            lidar_hm = np.load(file_path, allow_pickle=True).item()
-        else:
-            cloud = self.get_cloud(id)
-            points = position(cloud)
-            lidar_hm = self.estimate_heightmap(points, **kwargs)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            np.save(file_path, lidar_hm)
-        height = lidar_hm['z']
+        store = self.get_terrain_store(dir_name)
+        hm = store.get(id) if cached else None
+        if hm is None:
+            # height maps cached by older versions as pickled dicts
+            file_path = os.path.join(dir_name, '%05d.npy' % self.lid_index[id])
+            if cached and os.path.exists(file_path):
+                lidar_hm = np.load(file_path, allow_pickle=True).item()
+            else:
+                cloud = self.get_cloud(id)
+                points = position(cloud)
+                lidar_hm = self.estimate_heightmap(points, **kwargs)
+            hm = store.put(id, lidar_hm['z'], lidar_hm['mask'])
+        height = hm[0]
         # masking out the front part of the height map
-        mask = lidar_hm['mask'] * self.crop_front_height_map(height[None], only_mask=True)
+        mask = hm[1] * self.crop_front_height_map(height[None], only_mask=True)
         heightmap = torch.from_numpy(np.stack([height, mask]))
         return heightmap
 
@@ -457,19 +530,23 @@ class Rellis3D(Rellis3DBase):
         """
         if dir_name is None:
             dir_name = os.path.join(self.path, 'terrain', 'traj', 'footprint')
-        file_path = os.path.join(dir_name, '%05d.npy' % self.ids.index(id))
-        if cached and os.path.exists(file_path):
-            hm_rigid = np.load(file_path, allow_pickle=True).item()
-        else:
-            traj_points = self.get_footprint_traj_points(id)
-            obstacle_points = self.get_obstacles_points(id)
-            points = np.concatenate([traj_points, obstacle_points], axis=0)
-            hm_rigid = self.estimate_heightmap(points, robot_radius=None)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            np.save(file_path, hm_rigid)
-        height = hm_rigid['z']
+        # rasterized footprints differ from the footprint points of older versions, their height maps
+        # are stored separately and the old ones are not reused
+        rasterized = self.dphys_cfg.hm_interp_method is None
+        store = self.get_terrain_store(dir_name, name='store_rasterized' if rasterized else 'store')
+        hm = store.get(id) if cached else None
+        if hm is None:
+            # height maps cached by older versions as pickled dicts
+            file_path = os.path.join(dir_name, '%05d.npy' % self.lid_index[id])
+            if cached and not rasterized and os.path.exists(file_path):
+                hm_rigid = np.load(file_path, allow_pickle=True).item()
+            else:
+                obstacle_points = self.get_obstacles_points(id)
+                hm_rigid = self.get_footprint_traj_height_map(id, obstacle_points=obstacle_points)
+            hm = store.put(id, hm_rigid['z'], hm_rigid['mask'])
+        height = hm[0]
         # masking out the front part of the height map
-        mask = hm_rigid['mask'] * self.crop_front_height_map(height[None], only_mask=True)
+        mask = hm[1] * self.crop_front_height_map(height[None], only_mask=True)
         heightmap = torch.from_numpy(np.stack([height, mask]))
         return heightmap
 
@@ -530,33 +607,40 @@ class Rellis3D(Rellis3DBase):
 
         return outputs
 
-    def get_sample(self, id):
-        inputs = self.get_image_data(id)
-        inputs = [i.unsqueeze(0) for i in inputs]
-        img, rot, tran, K, post_rot, post_tran = inputs
-        hm_geom = torch.as_tensor(self.get_geom_height_map(id))
-        hm_terrain = torch.as_tensor(self.get_terrain_height_map(id))
+    def get_sample_fields(self, id, fields=None):
+        """
+        Sample with the named fields (all `sample_fields` by default),
+        only the data of the given fields are loaded.
+        """
+        if fields is None:
+            fields = self.sample_fields
+        fields = set(fields)
+        sample = Sample()
+        if fields & set(IMG_FIELDS):
+            sample.update(zip(IMG_FIELDS, [i.unsqueeze(0) for i in self.get_image_data(id)]))
+        if 'hm_geom' in fields:
+            sample['hm_geom'] = torch.as_tensor(self.get_geom_height_map(id))
+        if 'hm_terrain' in fields:
+            sample['hm_terrain'] = torch.as_tensor(self.get_terrain_height_map(id))
         if self.only_front_hm:
-            hm_geom = self.crop_front_height_map(hm_geom)
-            hm_terrain = self.crop_front_height_map(hm_terrain)
-        return img, rot, tran, K, post_rot, post_tran, hm_geom, hm_terrain
+            for name in fields & {'hm_geom', 'hm_terrain'}:
+                sample[name] = self.crop_front_height_map(sample[name])
+        if 'points' in fields:
+            sample['points'] = torch.as_tensor(position(self.get_cloud(id))).T
+        return Sample((name, value) for name, value in sample.items() if name in fields)
+
+    def get_sample(self, id):
+        sample = self.get_sample_fields(id, self.fields)
+        if self.fields is None:
+            return tuple(sample.values())
+        return sample
 
 
 class Rellis3DPoints(Rellis3D):
-    def __init__(self, path, lss_cfg, dphys_cfg=DPhysConfig(), is_train=False, only_front_hm=False):
-        super().__init__(path, lss_cfg, dphys_cfg, is_train, only_front_hm)
+    sample_fields = Rellis3D.sample_fields + ('points',)
 
-    def get_sample(self, id):
-        inputs = self.get_image_data(id)
-        inputs = [i.unsqueeze(0) for i in inputs]
-        img, rot, tran, K, post_rot, post_tran = inputs
-        hm_lidar = torch.as_tensor(self.get_geom_height_map(id))
-        hm_traj = torch.as_tensor(self.get_terrain_height_map(id))
-        if self.only_front_hm:
-            hm_lidar = self.crop_front_height_map(hm_lidar)
-            hm_traj = self.crop_front_height_map(hm_traj)
-        lidar_pts = torch.as_tensor(position(self.get_cloud(id))).T
-        return img, rot, tran, K, post_rot, post_tran, hm_lidar, hm_traj, lidar_pts
+    def __init__(self, path, lss_cfg, dphys_cfg=DPhysConfig(), is_train=False, only_front_hm=False, fields=None):
+        super().__init__(path, lss_cfg, dphys_cfg, is_train, only_front_hm, fields)
 
 
 def global_map_demo():
@@ -570,15 +654,7 @@ def global_map_demo():
         plt.grid()
         plt.show()
 
-        clouds = []
-        for i in tqdm(range(0, len(ds), 100)):
-            cloud, pose, img, K = ds[i]
-            cloud = filter_grid(cloud, grid_res=0.5)
-            cloud = position(cloud)
-            cloud = transform_cloud(cloud, pose)
-
-            clouds.append(cloud)
-        cloud = np.concatenate(clouds)
+        cloud = ds.get_global_cloud(grid_res=0.5, step=100)
 
         poses_pcd = o3d.geometry.PointCloud()
         poses_pcd.points = o3d.utility.Vector3dVector(ds.poses[:, :3, 3])
@@ -611,7 +687,7 @@ def traversed_cloud_demo():
     poses = traj['poses']
 
     footprint_traj = ds.get_footprint_traj_points(id)
-    print(cloud.shape, poses.shape, footprint_traj.shape)
+    print(cloud, poses.shape, footprint_traj.shape)
 
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(points)
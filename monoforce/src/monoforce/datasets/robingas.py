@@ -1,21 +1,24 @@
 import copy
 import os
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib as mpl
 import numpy as np
 import torch
 import torchvision
 from skimage.draw import polygon
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from matplotlib import pyplot as plt
-from ..models.terrain_encoder.utils import img_transform, normalize_img, ego_to_cam, get_only_in_img_mask, sample_augmentation
+from ..models.terrain_encoder.utils import img_transform, img_transform_matrices, normalize_img, sample_augmentation
 from ..config import DPhysConfig
-from ..transformations import transform_cloud
-from ..cloudproc import estimate_heightmap, hm_to_cloud, filter_range
-from ..utils import position, timing, read_yaml
-from ..cloudproc import filter_grid
+from ..transformations import transform_cloud, transform_clouds, poses_to_states
+from ..cloudproc import PointCloud, estimate_heightmap, rasterize_footprints, hm_to_cloud, filter_range, segment_ground
+from ..utils import position, timing, read_yaml, write_to_yaml
+from ..cloudproc import filter_grid, build_voxel_map, save_points, load_points
 from ..imgproc import undistort_image
-from ..utils import normalize, load_calib
+from ..utils import normalize, load_calib, nearest_index, interp_windows, mtimes
 from .coco import COCO_CATEGORIES
+from .storage import ShardedArrayWriter, ShardedArrays, TerrainStore, CloudStoreWriter, CloudStore
+from .sample import Sample, IMG_FIELDS, CONTROL_FIELDS, TRAJ_FIELDS
 import cv2
 import albumentations as A
 from PIL import Image
@@ -37,11 +40,16 @@ __all__ = [
     'RobinGasBase',
     'RobinGas',
     'RobinGasPoints',
+    'RobinGasCached',
     'robingas_seq_paths',
 ]
 
 data_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'data'))
 
+# segmentation label to color lookup table, the last label is void
+coco_colors = np.asarray([c['color'] for c in COCO_CATEGORIES] + [[0, 0, 0]], dtype=np.uint8)
+coco_classes = [c['name'].replace('-merged', '').replace('-other', '') for c in COCO_CATEGORIES] + ['void']
+
 robingas_seq_paths = {
     'husky': [
         os.path.join(data_dir, 'RobinGas/husky/husky_2022-10-27-15-33-57'),
@@ -90,9 +98,18 @@ class RobinGasBase(Dataset):
         - clouds
             - <id>.npz
             - ...
+        - cache
+            - clouds
+                - index.yaml
+                - xyz.bin
+                - ...
         - images
             - <id>_<camera_name>.png
             - ...
+            - reduced
+                - <id>_<camera_name>.jpg
+                - ...
+                - meta.yaml
         - trajectories
             - <id>.csv
             - ...
@@ -102,8 +119,15 @@ class RobinGasBase(Dataset):
                 - ...
             - transformations.yaml
         - terrain
-            - <id>.npy
-            - ...
+            - lidar
+                - store
+            - traj
+                - footprint
+                    - store
+                    - store_rasterized
+                - footprint_<points_source>_semantics
+                    - store
+                    - store_rasterized
         - poses
             - lidar_poses.csv
             - ...
@@ -114,6 +138,10 @@ class RobinGasBase(Dataset):
     - trajectory (T x 4 x 4), where the horizon T is the number of poses
     """
 
+    # sequence metadata (calibration, ids, stamps, poses, cameras) shared by all datasets of the same path,
+    # reloaded when the sequence files change
+    seq_data = {}
+
     def __init__(self, path, dphys_cfg=DPhysConfig()):
         super(Dataset, self).__init__()
         self.path = path
@@ -125,10 +153,48 @@ class RobinGasBase(Dataset):
         self.calib_path = os.path.join(path, 'calibration')
         self.controls_path = os.path.join(path, 'controls', 'tracks_vel.csv')
         self.dphys_cfg = dphys_cfg
-        self.calib = load_calib(calib_path=self.calib_path)
-        self.ids = self.get_ids()
-        self.ts, self.poses = self.get_poses(return_stamps=True)
-        self.camera_names = self.get_camera_names()
+        seq_key = os.path.realpath(path)
+        stamp = self.get_seq_stamp()
+        if RobinGasBase.seq_data.get(seq_key, (None,))[0] != stamp:
+            self.calib = load_calib(calib_path=self.calib_path)
+            ids = self.get_ids()
+            ts, poses = self.get_poses(return_stamps=True)
+            # velocities of the robot along the whole sequence
+            _, xds, _, omegas = poses_to_states(poses, ts)
+            RobinGasBase.seq_data[seq_key] = (stamp, (self.calib, ids, ts, poses, (xds, omegas),
+                                                      self.get_camera_names()))
+        self.calib, self.ids, self.ts, self.poses, self.seq_vels, camera_names = RobinGasBase.seq_data[seq_key][1]
+        # stamps, poses and velocities of the whole sequence and the sequence frames of the samples
+        self.seq_ts, self.seq_poses = self.ts, self.poses
+        self.frames = np.arange(len(self.ts))
+        self.camera_names = list(camera_names)
+        # lidar clouds in the robot frame compiled with `compile_clouds`
+        self.cloud_store_path = os.path.join(path, 'cache', 'clouds')
+        self.init_caches()
+
+    def get_seq_stamp(self):
+        """Modification times of the files the sequence metadata is read from."""
+        cams_path = os.path.join(self.calib_path, 'cameras')
+        cams = sorted(os.listdir(cams_path)) if os.path.isdir(cams_path) else []
+        paths = [self.cloud_path, self.poses_path, os.path.join(self.calib_path, 'transformations.yaml'), cams_path]
+        return mtimes(paths + [os.path.join(cams_path, f) for f in cams])
+
+    @classmethod
+    def clear_seq_data(cls, path=None):
+        """Drop the shared metadata of a sequence (all sequences by default), it is loaded again by new datasets."""
+        if path is None:
+            RobinGasBase.seq_data.clear()
+        else:
+            RobinGasBase.seq_data.pop(os.path.realpath(path), None)
+
+    def init_caches(self):
+        # controls are loaded once on first use, resampled windows optionally precomputed
+        self.controls = None
+        self.track_vels = None
+        self.terrain_stores = {}
+        self.cloud_store = None
+        if self.cloud_store_path is not None and CloudStore.exists(self.cloud_store_path):
+            self.cloud_store = CloudStore(self.cloud_store_path)
 
     def get_ids(self):
         ids = [f[:-4] for f in os.listdir(self.cloud_path)]
@@ -149,8 +215,7 @@ class RobinGasBase(Dataset):
         stamps, Ts = data[:, 0], data[:, 1:13]
         lidar_poses = np.asarray([self.pose2mat(pose) for pose in Ts], dtype=np.float32)
         # poses of the robot in the map frame
-        Tr_robot_lidar = self.calib['transformations']['T_base_link__os_sensor']['data']
-        Tr_robot_lidar = np.asarray(Tr_robot_lidar, dtype=np.float32).reshape((4, 4))
+        Tr_robot_lidar = self.calib.transform('T_base_link__os_sensor').astype(np.float32)
         Tr_lidar_robot = np.linalg.inv(Tr_robot_lidar)
         poses = lidar_poses @ Tr_lidar_robot
         if return_stamps:
@@ -160,37 +225,52 @@ class RobinGasBase(Dataset):
     def get_pose(self, i):
         return self.poses[i]
 
-    def get_track_vels(self, i):
-        if not os.path.exists(self.controls_path):
-            print(f'Controls file {self.controls_path} does not exist')
-            return None
-
-        data = np.loadtxt(self.controls_path, delimiter=',', skiprows=1)
-        all_stamps, all_vels = data[:, 0], data[:, 1:]
-        time_left = copy.copy(self.ts[i])
+    def get_controls(self):
+        """Control stamps (N) and track velocities (N x 2) of the whole sequence."""
+        if self.controls is None:
+            if not os.path.exists(self.controls_path):
+                print(f'Controls file {self.controls_path} does not exist')
+                return None
+            data = np.loadtxt(self.controls_path, delimiter=',', skiprows=1)
+            self.controls = (data[:, 0], data[:, 1:])
+        return self.controls
+
+    def resample_track_vels(self, times):
+        """
+        Track velocities resampled with the simulation time step on the horizon windows starting at `times`.
+        :param times: start times of the windows (M)
+        :return: window time stamps (T), velocities (M x T x 2)
+        """
+        all_stamps, all_vels = self.get_controls()
+        times = np.asarray(times).reshape((-1,))
         T_horizon, dt = self.dphys_cfg.traj_sim_time, self.dphys_cfg.dt
-        time_right = time_left + T_horizon
         # find the closest index to the left and right in all times
-        il = np.argmin(np.abs(np.asarray(all_stamps) - time_left))
-        ir = np.argmin(np.abs(np.asarray(all_stamps) - time_right))
-        ir = max(il + 1, ir)
+        il = nearest_index(all_stamps, times)
+        ir = nearest_index(all_stamps, times + T_horizon)
+        ir = np.maximum(il + 1, ir)
         ir = np.clip(ir, 0, len(all_vels) - 1)
-        timestamps = np.asarray(all_stamps[il:ir])
-        timestamps = timestamps - timestamps[0]
-        vels = all_vels[il:ir]
 
         # velocities interpolation
-        interp_times = np.arange(0.0, time_right - time_left, dt)
-        interp_vels = np.zeros((len(interp_times), 2))
-        for i in range(vels.shape[1]):
-            interp_vels[:, i] = np.interp(interp_times, timestamps, vels[:, i])
+        interp_times = np.arange(0.0, T_horizon, dt)
+        vels = interp_windows(all_stamps[il, None] + interp_times, all_stamps, all_vels, il, ir)
+        assert vels.shape[1] == len(interp_times) == int(T_horizon / dt), \
+            f'Velocity and time stamps have different lengths'
+
+        return interp_times, np.asarray(vels, dtype=np.float32)
 
-        timestamps = interp_times
-        vels = interp_vels
-        assert len(timestamps) == len(vels), f'Velocity and time stamps have different lengths'
-        assert len(timestamps) == int(T_horizon / dt), f'Velocity and time stamps have different lengths'
+    def precompute_track_vels(self):
+        """Resample track velocities of all sequence frames in one pass."""
+        if self.get_controls() is not None:
+            self.track_vels = self.resample_track_vels(self.seq_ts)
 
-        return timestamps, np.asarray(vels, dtype=np.float32)
+    def get_track_vels(self, i):
+        if self.track_vels is not None:
+            timestamps, vels = self.track_vels
+            return timestamps, vels[self.frames[i]]
+        if self.get_controls() is None:
+            return None
+        timestamps, vels = self.resample_track_vels(self.ts[i])
+        return timestamps, vels[0]
 
     def get_camera_names(self):
         cams_yaml = os.listdir(os.path.join(self.path, 'calibration/cameras'))
@@ -199,30 +279,32 @@ class RobinGasBase(Dataset):
             cams.remove('camera_up')
         return sorted(cams)
 
-    def get_traj(self, i, n_frames=10):
-        # n_frames equals to the number of future poses (trajectory length)
+    def get_traj_frames(self, i, n_frames=10):
+        """Sequence frames (n_frames) of the trajectory starting at the sample and their time stamps."""
         T_horizon = self.dphys_cfg.traj_sim_time
-
-        # get trajectory as sequence of `n_frames` future poses
-        all_poses = self.get_poses(return_stamps=False)
-        all_ts = copy.copy(self.ts)
-        il = i
-        ir = np.argmin(np.abs(all_ts - (self.ts[i] + T_horizon)))
+        all_ts = self.seq_ts
+        il = self.frames[i]
+        ir = nearest_index(all_ts, all_ts[il] + T_horizon)
         ir = min(max(ir, il+1), len(all_ts))
-        poses = all_poses[il:ir]
+        frames = np.arange(il, ir)
         stamps = np.asarray(all_ts[il:ir])
 
         # make sure the trajectory has the fixed length
-        if len(poses) < n_frames:
+        if len(frames) < n_frames:
             # repeat the last pose to fill the trajectory
-            poses = np.concatenate([poses, np.tile(poses[-1:], (n_frames - len(poses), 1, 1))], axis=0)
-            dt = np.mean(np.diff(stamps))
+            frames = np.concatenate([frames, np.full(n_frames - len(frames), frames[-1])])
+            dt = np.mean(np.diff(stamps)) if len(stamps) > 1 else np.mean(np.diff(all_ts))
             stamps = np.concatenate([stamps, stamps[-1] + np.arange(1, n_frames - len(stamps) + 1) * dt], axis=0)
         # truncate the trajectory
-        poses = poses[:n_frames]
+        frames = frames[:n_frames]
         stamps = stamps[:n_frames]
-        assert len(poses) == len(stamps), f'Poses and time stamps have different lengths'
-        assert len(poses) == n_frames
+        assert len(frames) == len(stamps) == n_frames, f'Poses and time stamps have different lengths'
+        return frames, stamps
+
+    def get_traj(self, i, n_frames=10):
+        # n_frames equals to the number of future poses (trajectory length)
+        frames, stamps = self.get_traj_frames(i, n_frames=n_frames)
+        poses = self.seq_poses[frames]
 
         # transform poses to the same coordinate frame as the height map
         poses = np.linalg.inv(poses[0]) @ poses
@@ -235,58 +317,92 @@ class RobinGasBase(Dataset):
         return traj
 
     def get_states_traj(self, i):
-        traj = self.get_traj(i)
-        poses = traj['poses']
-        tstamps = traj['stamps']
+        """
+        Trajectory time stamps and states (positions, velocities, rotations, angular velocities)
+        in the frame of the height map, velocities are taken from the precomputed sequence velocities.
+        """
+        frames, stamps = self.get_traj_frames(i)
+        poses = self.seq_poses[frames]
 
-        # transform poses to the same coordinate frame as the height map
+        # transform poses and velocities to the same coordinate frame as the height map
         Tr = np.linalg.inv(poses[0])
-        poses = np.asarray([np.matmul(Tr, p) for p in poses])
+        poses = Tr @ poses
+        xs = poses[:, :3, 3]
+        Rs = poses[:, :3, :3]
+        xds, omegas = self.seq_vels
+        xds = xds[frames] @ Tr[:3, :3].T
+        omegas = omegas[frames] @ Tr[:3, :3].T
+        # the robot stands at the repeated last pose
+        repeated = np.concatenate([[False], frames[1:] == frames[:-1]])
+        xds[repeated] = 0.
+        omegas[repeated] = 0.
         # count time from 0
-        tstamps = tstamps - tstamps[0]
+        ts = stamps - stamps[0]
 
-        xs = np.asarray(poses[:, :3, 3])
-        Rs = np.asarray(poses[:, :3, :3])
-
-        n_states = len(xs)
-        ts = np.asarray(tstamps)
-
-        dps = np.diff(xs, axis=0)
-        dt = np.asarray(np.diff(ts), dtype=np.float32).reshape([-1, 1])
-        theta = np.arctan2(dps[:, 1], dps[:, 0]).reshape([-1, 1])
-        theta = np.concatenate([theta[:1], theta], axis=0)
-
-        xds = np.zeros_like(xs)
-        xds[:-1] = dps / dt
-        omegas = np.zeros_like(xs)
-        omegas[:-1, 2:3] = np.diff(theta, axis=0) / dt  # + torch.diff(angles, dim=0)[:, 2:3] / dt
-
-        states = (xs.reshape([n_states, 3]),
-                  xds.reshape([n_states, 3]),
-                  Rs.reshape([n_states, 3, 3]),
-                  omegas.reshape([n_states, 3]))
+        states = (xs, xds, Rs, omegas)
 
         return ts, states
 
-    def get_raw_cloud(self, i):
+    def get_raw_cloud(self, i, organized=False):
         ind = self.ids[i]
         cloud_path = os.path.join(self.cloud_path, '%s.npz' % ind)
         assert os.path.exists(cloud_path), f'Cloud path {cloud_path} does not exist'
         cloud = np.load(cloud_path)['cloud']
-        if cloud.ndim == 2:
+        if cloud.ndim == 2 and not organized:
             cloud = cloud.reshape((-1,))
         return cloud
 
-    def get_lidar_cloud(self, i):
-        cloud = self.get_raw_cloud(i)
-        # remove nans from structured array with fields x, y, z
+    def get_lidar_cloud(self, i, fields=None):
+        """
+        Lidar cloud (PointCloud) in the robot frame without NaNs.
+        :param i: index of the sample
+        :param fields: point fields required besides x, y, z, the cloud is read from the raw files
+                       if the compiled cloud store does not contain them (it keeps only x, y, z and intensity)
+        """
+        if self.cloud_store is not None and set(fields or ()) <= set(self.cloud_store.fields):
+            cloud = self.cloud_store.get(self.ids[i])
+            if cloud is not None:
+                return cloud
+        cloud = PointCloud.from_structured(self.get_raw_cloud(i))
+        # remove nans
         cloud = cloud[~np.isnan(cloud['x'])]
         # move points to robot frame
-        Tr = self.calib['transformations']['T_base_link__os_sensor']['data']
-        Tr = np.asarray(Tr, dtype=float).reshape((4, 4))
-        cloud = transform_cloud(cloud, Tr)
+        cloud.transform(self.calib.transform('T_base_link__os_sensor'))
         return cloud
     
+    def compile_clouds(self, resolution=0.005, intensity=False):
+        """
+        Store the lidar clouds of the sequence in the robot frame without NaNs into one memory-mapped file
+        with coordinates quantized to `resolution` [m], read by `get_lidar_cloud` instead of the raw clouds.
+        :param intensity: store also point intensities
+        """
+        self.cloud_store = None
+        writer = CloudStoreWriter(self.cloud_store_path, resolution=resolution, intensity=intensity)
+        for i in tqdm(range(len(self))):
+            cloud = self.get_lidar_cloud(i)
+            writer.write(self.ids[i], position(cloud), intensity=cloud['intensity'] if intensity else None)
+        writer.close()
+        self.cloud_store = CloudStore(self.cloud_store_path)
+
+    def get_ground_segmented_points(self, i, max_slope=np.pi / 12.):
+        """
+        Lidar points in the robot frame without overhanging obstacles.
+
+        Ground points are segmented in the organized lidar cloud and obstacle points higher than
+        `h_max_above_ground` above the ground of their range image column are removed.
+        :param i: index of the sample
+        :param max_slope: maximal terrain inclination between consecutive lidar beams [rad]
+        :return: points (N x 3), ground mask (N), obstacle mask (N)
+        """
+        cloud = self.get_raw_cloud(i, organized=True)
+        assert cloud.ndim == 2, f'Ground segmentation requires an organized cloud, got shape {cloud.shape}'
+        Tr = self.calib.transform('T_base_link__os_sensor')
+        points = transform_cloud(position(cloud.ravel()), Tr).reshape(cloud.shape + (3,))
+        ground, obstacle, height = segment_ground(points, max_slope=max_slope, return_height=True)
+        obstacle &= ~(height > self.dphys_cfg.h_max_above_ground)
+        mask = ground | obstacle
+        return points[mask], ground[mask], obstacle[mask]
+
     def get_raw_radar_cloud(self, i):
         ind = self.ids[i]
         cloud_path = os.path.join(self.radar_cloud_path, '%s.npz' % ind)
@@ -297,54 +413,67 @@ class RobinGasBase(Dataset):
         return cloud
     
     def get_radar_cloud(self, i):
-        cloud = self.get_raw_radar_cloud(i)
-        # remove nans from structured array with fields x, y, z
+        cloud = PointCloud.from_structured(self.get_raw_radar_cloud(i))
+        # remove nans
         cloud = cloud[~np.isnan(cloud['x'])]
         # close by points contain noise
         cloud = filter_range(cloud, 3.0, np.inf)
         # move points to robot frame
-        Tr = self.calib['transformations']['T_base_link__hugin_radar']['data']
-        Tr = np.asarray(Tr, dtype=float).reshape((4, 4))
-        cloud = transform_cloud(cloud, Tr)
+        cloud.transform(self.calib.transform('T_base_link__hugin_radar'))
         return cloud
 
-    def get_cloud(self, i, points_source='lidar'):
+    def get_cloud(self, i, points_source='lidar', fields=None):
         assert points_source in ['lidar', 'radar', 'lidar_radar']
         if points_source == 'lidar':
-            return self.get_lidar_cloud(i)
+            return self.get_lidar_cloud(i, fields=fields)
         elif points_source == 'radar':
             return self.get_radar_cloud(i)
         else:
             lidar_points = self.get_lidar_cloud(i)
             radar_points = self.get_radar_cloud(i)
-            cloud = np.concatenate((lidar_points[['x', 'y', 'z']], radar_points[['x', 'y', 'z']]))
+            cloud = PointCloud(np.concatenate((lidar_points.xyz, radar_points.xyz)))
             return cloud
 
-    def get_geom_height_map(self, i, cached=True, dir_name=None, points_source='lidar', **kwargs):
+    def get_geom_height_map(self, i, cached=True, dir_name=None, points_source='lidar', ground_segmentation=False,
+                            **kwargs):
         """
         Get height map from lidar point cloud.
         :param i: index of the sample
         :param cached: if True, load height map from file if it exists, otherwise estimate it
-        :param dir_name: directory to save/load height map
+        :param dir_name: directory to save/load height map, terrain/<points_source>[_ground] by default
+        :param ground_segmentation: if True, remove overhanging obstacles using range image ground segmentation
         :param kwargs: additional arguments for height map estimation
         :return: height map (2 x H x W), where 2 is the number of channels (z and mask)
         """
         if dir_name is None:
-            dir_name = os.path.join(self.path, 'terrain', 'lidar')
-        file_path = os.path.join(dir_name, f'{self.ids[i]}.npy')
-        if cached and os.path.exists(file_path):
-            lidar_hm = np.load(file_path, allow_pickle=True).item()
-        else:
-            cloud = self.get_cloud(i, points_source=points_source)
-            points = position(cloud)
-            lidar_hm = self.estimate_heightmap(points, **kwargs)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            np.save(file_path, lidar_hm)
-        height = lidar_hm['z']
-        mask = lidar_hm['mask']
-        heightmap = torch.from_numpy(np.stack([height, mask]))
+            # height maps of other point sources and ground segmented ones are stored separately
+            name = points_source + ('_ground' if ground_segmentation else '')
+            dir_name = os.path.join(self.path, 'terrain', name)
+        store = self.get_terrain_store(dir_name)
+        heightmap = store.get(self.ids[i]) if cached else None
+        if heightmap is None:
+            # height maps cached by older versions as pickled dicts
+            file_path = os.path.join(dir_name, f'{self.ids[i]}.npy')
+            if cached and os.path.exists(file_path):
+                lidar_hm = np.load(file_path, allow_pickle=True).item()
+            else:
+                if ground_segmentation:
+                    assert points_source == 'lidar', 'Ground segmentation is supported only for lidar clouds'
+                    points, _, _ = self.get_ground_segmented_points(i)
+                else:
+                    points = position(self.get_cloud(i, points_source=points_source))
+                lidar_hm = self.estimate_heightmap(points, **kwargs)
+            heightmap = store.put(self.ids[i], lidar_hm['z'], lidar_hm['mask'])
+        heightmap = torch.from_numpy(heightmap)
         return heightmap
 
+    def get_terrain_store(self, dir_name, name='store'):
+        # one height map store per sequence and terrain type, indexed by all sequence ids
+        path = os.path.join(dir_name, name)
+        if path not in self.terrain_stores:
+            self.terrain_stores[path] = TerrainStore(path, ids=self.get_ids())
+        return self.terrain_stores[path]
+
     def get_traj_dphysics_terrain(self, i):
         ind = self.ids[i]
         p = os.path.join(self.path, 'terrain', 'traj', 'dphysics', '%s.npy' % ind)
@@ -360,43 +489,62 @@ class RobinGasBase(Dataset):
         z = np.zeros_like(x)
         footprint0 = np.stack([x, y, z], axis=-1).reshape((-1, 3))
 
-        Tr_base_link__base_footprint = np.asarray(self.calib['transformations']['T_base_link__base_footprint']['data'],
-                                                  dtype=float).reshape((4, 4))
+        Tr_base_link__base_footprint = self.calib.transform('T_base_link__base_footprint')
         traj = self.get_traj(i)
         poses = traj['poses']
         poses_footprint = poses @ Tr_base_link__base_footprint
 
-        trajectory_points = []
-        for Tr in poses_footprint:
-            footprint = transform_cloud(footprint0, Tr)
-            trajectory_points.append(footprint)
-        trajectory_points = np.concatenate(trajectory_points, axis=0)
+        trajectory_points = transform_clouds(poses_footprint, footprint0).reshape((-1, 3))
         return trajectory_points
 
-    def get_global_cloud(self, vis=False, cached=True, save=False, step=1):
-        path = os.path.join(self.path, 'map', 'map.pcd')
+    def get_footprint_traj_height_map(self, i, obstacle_points=None, robot_size=(0.7, 1.0)):
+        """
+        Height map of the robot footprint swept along the trajectory and optional obstacle points.
+        The footprint rectangles are rendered directly into the grid, interpolated height maps
+        (`hm_interp_method` is set) are estimated from the footprint points.
+        :return: height map dict with x, y, z and mask grids
+        """
+        if self.dphys_cfg.hm_interp_method is not None:
+            points = self.get_footprint_traj_points(i, robot_size=robot_size)
+            if obstacle_points is not None:
+                points = np.concatenate((obstacle_points, points), axis=0)
+            return self.estimate_heightmap(points, robot_radius=None)
+
+        hm_obstacles = None
+        if obstacle_points is not None and len(obstacle_points) > 0:
+            hm_obstacles = self.estimate_heightmap(obstacle_points, robot_radius=None)
+        width, length = robot_size
+        Tr_base_link__base_footprint = self.calib.transform('T_base_link__base_footprint')
+        poses_footprint = self.get_traj(i)['poses'] @ Tr_base_link__base_footprint
+        height = rasterize_footprints(poses_footprint, length=length, width=width,
+                                      d_max=self.dphys_cfg.d_max, grid_res=self.dphys_cfg.grid_res,
+                                      h_max_above_ground=self.dphys_cfg.h_max_above_ground,
+                                      robot_clearance=self.calib['clearance'], heightmap=hm_obstacles)
+        return height
+
+    def get_map_points(self, i):
+        # lidar points of the sample in the map frame
+        cloud = self.get_cloud(i)
+        points = transform_cloud(position(cloud), self.get_pose(i))
+        return points
+
+    def get_global_cloud(self, vis=False, cached=True, save=False, step=1, n_workers=0):
+        path = os.path.join(self.path, 'map', 'map.npy')
+        pcd_path = os.path.join(self.path, 'map', 'map.pcd')
         if cached and os.path.exists(path):
+            global_cloud = load_points(path)
+        elif cached and os.path.exists(pcd_path):
             # print('Loading global cloud from file...')
-            pcd = o3d.io.read_point_cloud(path)
+            pcd = o3d.io.read_point_cloud(pcd_path)
             global_cloud = np.asarray(pcd.points, dtype=np.float32)
         else:
             # create global cloud
-            global_cloud = None
-            for i in tqdm(range(len(self))[::step]):
-                cloud = self.get_cloud(i)
-                T = self.get_pose(i)
-                cloud = transform_cloud(cloud, T)
-                points = position(cloud)
-                points = filter_grid(points, self.dphys_cfg.grid_res, keep='first', log=False)
-                if i == 0:
-                    global_cloud = points
-                else:
-                    global_cloud = np.vstack((global_cloud, points))
+            ids = list(range(len(self)))[::step]
+            voxel_map = build_voxel_map(self.get_map_points, ids, self.dphys_cfg.grid_res, n_workers=n_workers)
+            global_cloud = voxel_map.get_points()
             # save global cloud to file
             if save:
-                pcd = o3d.geometry.PointCloud()
-                pcd.points = o3d.utility.Vector3dVector(global_cloud)
-                o3d.io.write_point_cloud(path, pcd)
+                save_points(path, global_cloud)
 
         if vis:
             # remove nans
@@ -410,7 +558,7 @@ class RobinGasBase(Dataset):
             pcd = o3d.geometry.PointCloud()
             pcd.points = o3d.utility.Vector3dVector(global_cloud_vis)
 
-            poses = self.get_poses()
+            poses = self.seq_poses
             pcd_poses = o3d.geometry.PointCloud()
             pcd_poses.points = o3d.utility.Vector3dVector(poses[:, :3, 3])
             pcd_poses.paint_uniform_color([0.8, 0.1, 0.1])
@@ -439,14 +587,18 @@ class RobinGasBase(Dataset):
             sample = self.get_sample(i)
             return sample
 
-        ds = copy.deepcopy(self)
+        # index view sharing the sequence data (calibration, sequence poses, controls, stores)
+        ds = copy.copy(self)
         if isinstance(i, (list, tuple, np.ndarray)):
-            ds.ids = [self.ids[k] for k in i]
-            ds.poses = [self.poses[k] for k in i]
+            i = np.asarray(i, dtype=int)
         else:
             assert isinstance(i, (slice, range))
-            ds.ids = self.ids[i]
-            ds.poses = self.poses[i]
+            if isinstance(i, range):
+                i = slice(i.start, i.stop, i.step)
+        ds.ids = self.ids[i]
+        ds.poses = self.poses[i]
+        ds.ts = self.ts[i]
+        ds.frames = self.frames[i]
         return ds
 
     def __iter__(self):
@@ -471,24 +623,65 @@ class RobinGas(RobinGasBase):
     - lidar height map (2 x H x W)
     - trajectory height map (2 x H x W)
     - map pose (4 x 4)
+
+    The sample is a tuple of all fields by default. If the names of the required `fields`
+    (see `sample_fields`) are given, the sample is a Sample with only these fields
+    and the data of the other fields are not loaded.
     """
 
+    # names of the sample fields in the order of the sample tuple
+    sample_fields = IMG_FIELDS + ('hm_geom', 'hm_terrain') + CONTROL_FIELDS + TRAJ_FIELDS
+
     def __init__(self,
                  path,
                  lss_cfg,
                  dphys_cfg=DPhysConfig(),
                  is_train=False,
                  only_front_cam=False,
-                 use_rigid_semantics=True):
+                 use_rigid_semantics=True,
+                 gpu_img_aug=False,
+                 n_img_threads=4,
+                 fields=None):
         super(RobinGas, self).__init__(path, dphys_cfg)
+        self.init_samples(lss_cfg, is_train=is_train, only_front_cam=only_front_cam,
+                          use_rigid_semantics=use_rigid_semantics, gpu_img_aug=gpu_img_aug,
+                          n_img_threads=n_img_threads, fields=fields)
+
+    def init_samples(self, lss_cfg, is_train, only_front_cam, use_rigid_semantics, gpu_img_aug, n_img_threads,
+                     fields):
+        # sample fields, cameras, image augmentations and image caches, shared with the datasets streaming bags
+        if fields is not None:
+            unknown = set(fields) - set(self.sample_fields)
+            assert not unknown, f'Unknown sample fields {unknown}, available fields are {self.sample_fields}'
+        self.fields = fields
+        self.points_source = 'lidar'
         self.is_train = is_train
         self.only_front_cam = only_front_cam
         self.use_rigid_semantics = use_rigid_semantics
+        # return uint8 images to be augmented on the training device with `augment_imgs`
+        self.gpu_img_aug = gpu_img_aug
         self.camera_names = self.camera_names[:1] if only_front_cam else self.camera_names
+        # camera images of a sample are decoded in parallel threads (divided among DataLoader workers),
+        # 0 or 1 decodes them sequentially
+        self.n_img_threads = n_img_threads
+        self.img_executor = None
 
         # initialize image augmentations
         self.lss_cfg = lss_cfg
         self.img_augs = self.get_img_augs()
+        # height map cells visible from the front camera, computed once for the masks of all samples
+        self.front_mask = torch.from_numpy(self.front_height_map_mask()) if only_front_cam else None
+
+        # raw image sizes read from file headers, downscaled copies of images
+        self.raw_img_sizes = {}
+        self.reduced_img_path = os.path.join(self.path, 'images', 'reduced')
+        self.reduced_img_size = self.get_reduced_img_size()
+
+    def __getstate__(self):
+        # the thread pool is created again in worker processes
+        state = self.__dict__.copy()
+        state['img_executor'] = None
+        return state
 
     def get_img_augs(self):
         if self.is_train:
@@ -509,10 +702,59 @@ class RobinGas(RobinGasBase):
         else:
             return None
 
-    def get_raw_image(self, i, camera=None):
+    def get_reduced_img_size(self):
+        meta_path = os.path.join(self.reduced_img_path, 'meta.yaml')
+        if not os.path.exists(meta_path):
+            return None
+        meta = read_yaml(meta_path)
+        # images of a partially compiled sequence are not read
+        if not meta.get('complete', True):
+            return None
+        return tuple(meta['img_size'])
+
+    def compile_reduced_images(self, quality=95):
+        """
+        Store downscaled JPEG copies of the images at the largest size the image augmentations resize to.
+        Already stored images of the same size and quality are kept, so the compilation can be resumed.
+        """
+        img_size = self.get_cache_img_size()
+        meta_path = os.path.join(self.reduced_img_path, 'meta.yaml')
+        meta = {'img_size': list(img_size), 'quality': quality}
+        # images stored with a different size or quality are overwritten
+        keep = os.path.exists(meta_path) and \
+            {k: v for k, v in read_yaml(meta_path).items() if k != 'complete'} == meta
+        os.makedirs(self.reduced_img_path, exist_ok=True)
+        # the meta is written before encoding, so an interrupted compilation can be resumed
+        write_to_yaml(dict(meta, complete=False), meta_path)
+        self.reduced_img_size = None
+        for i in tqdm(range(len(self))):
+            for cam in self.camera_names:
+                img_path = os.path.join(self.reduced_img_path, '%s_%s.jpg' % (self.ids[i], cam))
+                if keep and os.path.exists(img_path):
+                    continue
+                img = Image.open(os.path.join(self.path, 'images', '%s_%s.png' % (self.ids[i], cam)))
+                img = img.convert('RGB').resize(img_size, reducing_gap=2.0)
+                tmp_path = img_path[:-len('.jpg')] + '.tmp.jpg'
+                img.save(tmp_path, quality=quality)
+                os.replace(tmp_path, img_path)
+        write_to_yaml(dict(meta, complete=True), meta_path)
+        self.reduced_img_size = img_size
+
+    def get_raw_image(self, i, camera=None, size=None):
+        """
+        Image of the camera at the raw resolution.
+        :param size: (W, H) the caller resizes the image to, if given, a downscaled copy
+                     not smaller than `size` may be returned instead
+        """
         if camera is None:
             camera = self.camera_names[0]
         ind = self.ids[i]
+        if size is not None and self.reduced_img_size is not None \
+                and self.reduced_img_size[0] >= size[0] and self.reduced_img_size[1] >= size[1]:
+            img = Image.open(os.path.join(self.reduced_img_path, '%s_%s.jpg' % (ind, camera)))
+            # decode JPEG directly at a reduced scale if it is still larger than needed
+            img.draft('RGB', tuple(size))
+            return img
         img_path = os.path.join(self.path, 'images', '%s_%s.png' % (ind, camera))
         assert os.path.exists(img_path), f'Image path {img_path} does not exist'
         img = Image.open(img_path)
@@ -521,106 +763,141 @@ class RobinGas(RobinGasBase):
     def get_raw_img_size(self, i=0, cam=None):
         if cam is None:
             cam = self.camera_names[0]
-        img = self.get_raw_image(i, cam)
-        img = np.asarray(img)
-        return img.shape[0], img.shape[1]
+        if cam not in self.raw_img_sizes:
+            # the size is read from the file header without decoding the image
+            W, H = self.get_raw_image(i, cam).size
+            self.raw_img_sizes[cam] = (H, W)
+        return self.raw_img_sizes[cam]
 
-    def get_image(self, i, camera=None, undistort=False):
+    def get_image(self, i, camera=None, undistort=False, size=None):
         if camera is None:
             camera = self.camera_names[0]
-        img = self.get_raw_image(i, camera)
-        for key in self.calib.keys():
-            if camera in key:
-                camera = key
-                break
-        K = self.calib[camera]['camera_matrix']['data']
-        r, c = self.calib[camera]['camera_matrix']['rows'], self.calib[camera]['camera_matrix']['cols']
-        K = np.asarray(K, dtype=np.float32).reshape((r, c))
+        img = self.get_raw_image(i, camera, size=None if undistort else size)
+        # the camera name may be a part of the calibrated name
+        k = self.calib.camera_index(camera, fuzzy=True)
+        K, D = self.calib.Ks[k], self.calib.Ds[k]
+        K = K.copy()
+        # intrinsics of downscaled images (reduced copies or cached samples)
+        H, W = self.get_raw_img_size(i, camera)
+        if img.size != (W, H):
+            K[0] *= img.size[0] / W
+            K[1] *= img.size[1] / H
         if undistort:
-            D = self.calib[camera]['distortion_coefficients']['data']
-            D = np.array(D)
             img = np.asarray(img)
             img, K = undistort_image(img, K, D)
         return img, K
 
-    def get_images_data(self, i):
-        imgs = []
-        rots = []
-        trans = []
-        post_rots = []
-        post_trans = []
-        intrins = []
-
-        for cam in self.camera_names:
-            img, K = self.get_image(i, cam, undistort=False)
-            # if self.is_train:
-            #     img = self.img_augs(image=np.asarray(img))['image']
-
+    def get_img_executor(self):
+        # thread pool decoding camera images, recreated in forked DataLoader workers
+        n_threads = self.n_img_threads
+        worker = get_worker_info()
+        if worker is not None:
+            # the threads are shared by the DataLoader workers decoding samples in parallel
+            n_threads //= worker.num_workers
+        if n_threads <= 1:
+            return None
+        if self.img_executor is None or self.img_executor[0] != os.getpid():
+            self.img_executor = (os.getpid(), ThreadPoolExecutor(n_threads))
+        return self.img_executor[1]
+
+    def map_cameras(self, fn, cameras=None):
+        """Apply `fn` to the cameras (or camera indices) in parallel threads, PIL releases the GIL while decoding."""
+        if cameras is None:
+            cameras = self.camera_names
+        executor = self.get_img_executor()
+        if executor is None or len(cameras) < 2:
+            return [fn(cam) for cam in cameras]
+        return list(executor.map(fn, cameras))
+
+    def get_images(self, i, cameras=None, undistort=False):
+        """Raw images and intrinsics [(img, K), ...] of the cameras decoded in parallel."""
+        return self.map_cameras(lambda cam: self.get_image(i, cam, undistort=undistort), cameras)
+
+    def get_images_data(self, i, raw_imgs=None):
+        """
+        Camera inputs of the terrain encoder (imgs, rots, trans, intrins, post_rots, post_trans).
+        :param raw_imgs: raw images of the cameras already decoded by the caller (e.g. with `get_images`)
+        """
+        n_cams = len(self.camera_names)
+        if self.gpu_img_aug:
+            # images of the same size for batching, augmentations are only described by the homography
+            img_size = self.get_cache_img_size()
+            imgs = torch.empty((n_cams, img_size[1], img_size[0], 3), dtype=torch.uint8)
+        else:
+            fH, fW = self.lss_cfg['data_aug_conf']['final_dim']
+            imgs = torch.empty((n_cams, 3, fH, fW), dtype=torch.float32)
+        # calibration of the cameras
+        Es = self.calib.Es[self.calib.camera_indices(self.camera_names)]
+        assert not np.isnan(Es).any(), f'Extrinsics of cameras {self.camera_names} are not calibrated'
+        rots = torch.from_numpy(np.ascontiguousarray(Es[:, :3, :3]))
+        trans = torch.from_numpy(np.ascontiguousarray(Es[:, :3, 3]))
+        intrins = torch.from_numpy(self.calib.Ks[self.calib.camera_indices(self.camera_names)])
+        post_rots = torch.eye(3).repeat(n_cams, 1, 1)
+        post_trans = torch.zeros((n_cams, 3))
+
+        # augmentation (resize, crop, horizontal flip, rotate) sampled in the calling thread
+        augs = [sample_augmentation(self.lss_cfg, is_train=self.is_train) for _ in range(n_cams)]
+
+        def load_camera(k):
+            cam = self.camera_names[k]
+            resize, resize_dims, crop, flip, rotate = augs[k]
             post_rot = torch.eye(2)
             post_tran = torch.zeros(2)
 
-            # augmentation (resize, crop, horizontal flip, rotate)
-            resize, resize_dims, crop, flip, rotate = sample_augmentation(self.lss_cfg, is_train=self.is_train)
-            img, post_rot2, post_tran2 = img_transform(img, post_rot, post_tran,
-                                                       resize=resize,
-                                                       resize_dims=resize_dims,
-                                                       crop=crop,
-                                                       flip=flip,
-                                                       rotate=rotate)
+            if self.gpu_img_aug:
+                img = raw_imgs[k] if raw_imgs is not None else self.get_raw_image(i, cam, size=img_size)
+                img = img.convert('RGB')
+                if img.size != img_size:
+                    img = img.resize(img_size)
+                post_rot2, post_tran2 = img_transform_matrices(post_rot, post_tran, resize=resize, crop=crop,
+                                                               flip=flip, rotate=rotate)
+                imgs[k] = torch.from_numpy(np.array(img))
+            else:
+                img = raw_imgs[k] if raw_imgs is not None else self.get_raw_image(i, cam, size=resize_dims)
+                # if self.is_train:
+                #     img = self.img_augs(image=np.asarray(img))['image']
+
+                img, post_rot2, post_tran2 = img_transform(img, post_rot, post_tran,
+                                                           resize=resize,
+                                                           resize_dims=resize_dims,
+                                                           crop=crop,
+                                                           flip=flip,
+                                                           rotate=rotate)
+                imgs[k] = normalize_img(img)
 
             # for convenience, make augmentation matrices 3x3
-            post_tran = torch.zeros(3)
-            post_rot = torch.eye(3)
-            post_tran[:2] = post_tran2
-            post_rot[:2, :2] = post_rot2
-
-            # rgb and intrinsics
-            img = normalize_img(img)
-            K = torch.as_tensor(K)
-
-            # extrinsics
-            T_robot_cam = self.calib['transformations'][f'T_base_link__{cam}']['data']
-            T_robot_cam = np.asarray(T_robot_cam, dtype=np.float32).reshape((4, 4))
-            rot = torch.as_tensor(T_robot_cam[:3, :3])
-            tran = torch.as_tensor(T_robot_cam[:3, 3])
-
-            imgs.append(img)
-            rots.append(rot)
-            trans.append(tran)
-            intrins.append(K)
-            post_rots.append(post_rot)
-            post_trans.append(post_tran)
-
-        img_data = [torch.stack(imgs), torch.stack(rots), torch.stack(trans),
-                  torch.stack(intrins), torch.stack(post_rots), torch.stack(post_trans)]
-        img_data = [torch.as_tensor(i, dtype=torch.float32) for i in img_data]
+            post_rots[k, :2, :2] = post_rot2
+            post_trans[k, :2] = post_tran2
+
+        self.map_cameras(load_camera, list(range(n_cams)))
+        img_data = [imgs, rots, trans, intrins, post_rots, post_trans]
 
         return img_data
 
     def seg_label_to_color(self, seg_label):
-        coco_colors = [(np.array(color['color'])).tolist() for color in COCO_CATEGORIES] + [[0, 0, 0]]
+        # transform segmentation labels to colors, unknown labels are void
         seg_label = np.asarray(seg_label)
-        # transform segmentation labels to colors
-        size = [s for s in seg_label.shape] + [3]
-        seg_color = np.zeros(size, dtype=np.uint8)
-        for color_i, color in enumerate(coco_colors):
-            seg_color[seg_label == color_i] = color
+        seg_color = coco_colors[np.clip(seg_label, 0, len(coco_colors) - 1)]
         return seg_color
 
-    def get_seg_label(self, i, camera=None):
+    def get_raw_seg_label(self, i, camera=None):
         if camera is None:
             camera = self.camera_names[0]
         id = self.ids[i]
         seg_path = os.path.join(self.path, 'images/seg/', '%s_%s.npy' % (id, camera))
         assert os.path.exists(seg_path), f'Image path {seg_path} does not exist'
-        seg = Image.fromarray(np.load(seg_path))
+        return np.load(seg_path)
+
+    def get_seg_label(self, i, camera=None):
+        if camera is None:
+            camera = self.camera_names[0]
+        seg = Image.fromarray(self.get_raw_seg_label(i, camera))
         size = self.get_raw_img_size(i, camera)
         transform = torchvision.transforms.Resize(size)
         seg = transform(seg)
         return seg
     
     def get_semantic_cloud(self, i, classes=None, vis=False, points_source='lidar'):
-        coco_classes = [i['name'].replace('-merged', '').replace('-other', '') for i in COCO_CATEGORIES] + ['void']
         if classes is None:
             classes = np.copy(coco_classes)
         # ids of classes in COCO
@@ -629,32 +906,34 @@ class RobinGas(RobinGasBase):
             if c in coco_classes:
                 selected_labels.append(coco_classes.index(c))
 
-        lidar_points = position(self.get_cloud(i, points_source=points_source))
+        lidar_points = np.asarray(position(self.get_cloud(i, points_source=points_source)), dtype=np.float32)
+        cams = self.camera_names[::-1]
+        Ks = self.calib.Ks[self.calib.camera_indices(cams)]
+        Es = self.calib.Es[self.calib.camera_indices(cams)]
+        assert not np.isnan(Es).any(), f'Extrinsics of cameras {cams} are not calibrated'
+
+        # project points to all cameras at once: K @ R^T @ (p - t)
+        Rs, ts = Es[:, :3, :3], Es[:, :3, 3]
+        cam_points = (lidar_points[None] - ts[:, None]) @ Rs @ Ks.transpose(0, 2, 1)
+        depth = cam_points[..., 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            uv = cam_points[..., :2] / depth[..., None]
+
         points = []
         labels = []
-        for cam in self.camera_names[::-1]:
-            seg_label_cam = self.get_seg_label(i, camera=cam)
-            seg_label_cam = np.asarray(seg_label_cam)
-
-            K = self.calib[cam]['camera_matrix']['data']
-            K = np.asarray(K, dtype=np.float32).reshape((3, 3))
-            E = self.calib['transformations'][f'T_base_link__{cam}']['data']
-            E = np.asarray(E, dtype=np.float32).reshape((4, 4))
-    
-            lidar_points = torch.as_tensor(lidar_points)
-            E = torch.as_tensor(E)
-            K = torch.as_tensor(K)
-    
-            cam_points = ego_to_cam(lidar_points.T, E[:3, :3], E[:3, 3], K).T
-            mask = get_only_in_img_mask(cam_points.T, seg_label_cam.shape[0], seg_label_cam.shape[1])
-            cam_points = cam_points[mask]
+        for c, cam in enumerate(cams):
+            H, W = self.get_raw_img_size(i, cam)
+            u, v = uv[c, :, 0], uv[c, :, 1]
+            mask = (depth[c] > 0) & (u > 1) & (u < W - 1) & (v > 1) & (v < H - 1)
 
-            # colorize point cloud with values from segmentation image
-            uv = cam_points[:, :2].numpy().astype(int)
-            seg_label_cam = seg_label_cam[uv[:, 1], uv[:, 0]]
-    
-            points.append(lidar_points[mask].numpy())
-            labels.append(seg_label_cam)
+            # colorize point cloud with the nearest labels of the (smaller) segmentation image
+            seg_label_cam = self.get_raw_seg_label(i, camera=cam)
+            seg_H, seg_W = seg_label_cam.shape[:2]
+            rows = np.minimum((v[mask].astype(int) * seg_H) // H, seg_H - 1)
+            cols = np.minimum((u[mask].astype(int) * seg_W) // W, seg_W - 1)
+
+            points.append(lidar_points[mask])
+            labels.append(seg_label_cam[rows, cols])
 
         points = np.concatenate(points)
         labels = np.concatenate(labels)
@@ -675,16 +954,18 @@ class RobinGas(RobinGasBase):
 
         return points, colors
 
-    def global_hm_cloud(self, vis=False):
+    def get_map_hm_points(self, i):
+        # geometric height map of the sample as points in the map frame
+        hm = self.get_geom_height_map(i)
+        hm_cloud = hm_to_cloud(hm[0], self.dphys_cfg, mask=hm[1])
+        hm_cloud = transform_cloud(hm_cloud.cpu().numpy(), self.get_pose(i))
+        return hm_cloud
+
+    def global_hm_cloud(self, vis=False, n_workers=0):
         # create global heightmap cloud
-        global_hm_cloud = []
-        for i in tqdm(range(len(self))):
-            hm = self.get_geom_height_map(i)
-            pose = self.get_pose(i)
-            hm_cloud = hm_to_cloud(hm[0], self.dphys_cfg, mask=hm[1])
-            hm_cloud = transform_cloud(hm_cloud.cpu().numpy(), pose)
-            global_hm_cloud.append(hm_cloud)
-        global_hm_cloud = np.concatenate(global_hm_cloud, axis=0)
+        voxel_map = build_voxel_map(self.get_map_hm_points, list(range(len(self))),
+                                    self.dphys_cfg.grid_res, n_workers=n_workers)
+        global_hm_cloud = voxel_map.get_points()
 
         if vis:
             # plot global cloud with open3d
@@ -699,37 +980,37 @@ class RobinGas(RobinGasBase):
         :param i: index of the sample
         :param cached: if True, load height map from file if it exists, otherwise estimate it
         :param dir_name: directory to save/load height map
-        :param obstacle_classes: classes of obstacles to include in the height map
+        :param points_source: source of the semantic obstacle points
         :return: heightmap (2 x H x W), where 2 is the number of channels (z and mask)
         """
         if dir_name is None:
-            dir_name = os.path.join(self.path, 'terrain', 'traj', 'footprint')
-
-        file_path = os.path.join(dir_name, f'{self.ids[i]}.npy')
-        if cached and os.path.exists(file_path):
-            hm_rigid = np.load(file_path, allow_pickle=True).item()
-        else:
-            traj_points = self.get_footprint_traj_points(i)
-            if self.use_rigid_semantics:
-                seg_points, _ = self.get_semantic_cloud(i, classes=self.lss_cfg['obstacle_classes'],
-                                                        points_source=points_source, vis=False)
-                points = np.concatenate((seg_points, traj_points), axis=0)
+            # height maps with semantic obstacles are stored separately from the footprint-only ones
+            name = f'footprint_{points_source}_semantics' if self.use_rigid_semantics else 'footprint'
+            dir_name = os.path.join(self.path, 'terrain', 'traj', name)
+
+        # rasterized footprints differ from the footprint points of older versions, their height maps
+        # are stored separately and the old ones are not reused
+        rasterized = self.dphys_cfg.hm_interp_method is None
+        store = self.get_terrain_store(dir_name, name='store_rasterized' if rasterized else 'store')
+        heightmap = store.get(self.ids[i]) if cached else None
+        if heightmap is None:
+            # height maps cached by older versions as pickled dicts
+            file_path = os.path.join(dir_name, f'{self.ids[i]}.npy')
+            if cached and not rasterized and os.path.exists(file_path):
+                hm_rigid = np.load(file_path, allow_pickle=True).item()
             else:
-                points = traj_points
-            hm_rigid = self.estimate_heightmap(points, robot_radius=None)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            np.save(file_path, hm_rigid)
-        height = hm_rigid['z']
-        mask = hm_rigid['mask']
-
-        heightmap = torch.from_numpy(np.stack([height, mask]))
+                seg_points = None
+                if self.use_rigid_semantics:
+                    seg_points, _ = self.get_semantic_cloud(i, classes=self.lss_cfg['obstacle_classes'],
+                                                            points_source=points_source, vis=False)
+                hm_rigid = self.get_footprint_traj_height_map(i, obstacle_points=seg_points)
+            heightmap = store.put(self.ids[i], hm_rigid['z'], hm_rigid['mask'])
+
+        heightmap = torch.from_numpy(heightmap)
         return heightmap
 
     def front_height_map_mask(self):
-        camera = self.camera_names[0]
-        K = self.calib[camera]['camera_matrix']['data']
-        r, c = self.calib[camera]['camera_matrix']['rows'], self.calib[camera]['camera_matrix']['cols']
-        K = np.asarray(K, dtype=np.float32).reshape((r, c))
+        K = self.calib.Ks[self.calib.camera_index(self.camera_names[0])]
 
         # get fov from camera intrinsics
         img_h, img_w = self.lss_cfg['data_aug_conf']['H'], self.lss_cfg['data_aug_conf']['W']
@@ -756,48 +1037,175 @@ class RobinGas(RobinGasBase):
 
         return mask
 
-    def get_sample(self, i):
-        imgs, rots, trans, intrins, post_rots, post_trans = self.get_images_data(i)
-        control_ts, controls = self.get_track_vels(i)
+    def get_cache_img_size(self):
+        """Size (W, H) of cached images: the largest size the image augmentations resize to."""
+        H, W = self.lss_cfg['data_aug_conf']['H'], self.lss_cfg['data_aug_conf']['W']
+        fH, fW = self.lss_cfg['data_aug_conf']['final_dim']
+        scale = max(max(self.lss_cfg['data_aug_conf']['resize_lim']), fH / H, fW / W)
+        scale = min(scale, 1.)
+        return int(W * scale), int(H * scale)
+
+    def get_cache_sample(self, i):
+        img_size = self.get_cache_img_size()
+        imgs = np.stack([np.asarray(self.get_raw_image(i, cam, size=img_size).convert('RGB').resize(img_size))
+                         for cam in self.camera_names])
+        controls = self.get_track_vels(i)
+        assert controls is not None, f'Controls of sample {i} of sequence {self.name} are not available'
+        control_ts, controls = controls
         traj_ts, states = self.get_states_traj(i)
         Xs, Xds, Rs, Omegas = states
-        hm_geom = self.get_geom_height_map(i)
-        hm_terrain = self.get_terrain_height_map(i)
+        sample = {
+            'imgs': imgs,
+            'hm_geom': self.get_geom_height_map(i).numpy(),
+            'hm_terrain': self.get_terrain_height_map(i, cached=True).numpy(),
+            'control_ts': control_ts, 'controls': controls,
+            'traj_ts': traj_ts, 'Xs': Xs, 'Xds': Xds, 'Rs': Rs, 'Omegas': Omegas,
+        }
+        return sample
+
+    def compile_cache(self, cache_dir=None, shard_size=256):
+        """
+        Write fixed-shape samples (downscaled uint8 images, height maps, controls and trajectory states)
+        to sharded memory-mapped files read by RobinGasCached.
+        :param cache_dir: directory of the cache, default is <path>/cache/samples
+        :param shard_size: number of samples per shard
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(self.path, 'cache', 'samples')
+        sample = self.get_cache_sample(0)
+        fields = {name: (value.shape, value.dtype) for name, value in sample.items()}
+        meta = {
+            'ids': [str(id) for id in self.ids],
+            'camera_names': list(self.camera_names),
+            'img_size': list(self.get_cache_img_size()),
+            'raw_img_size': [int(s) for s in self.get_raw_img_size(0)],
+            'use_rigid_semantics': bool(self.use_rigid_semantics),
+        }
+        writer = ShardedArrayWriter(cache_dir, len(self), fields, shard_size=shard_size, meta=meta)
+        writer.write(0, sample)
+        for i in tqdm(range(1, len(self))):
+            writer.write(i, self.get_cache_sample(i))
+        writer.close()
+
+    def get_sample_fields(self, i, fields=None):
+        """
+        Sample with the named fields (all `sample_fields` by default),
+        only the data of the given fields are loaded.
+        """
+        if fields is None:
+            fields = self.sample_fields
+        fields = set(fields)
+        sample = Sample()
+        if fields & set(IMG_FIELDS):
+            sample.update(zip(IMG_FIELDS, self.get_images_data(i)))
+        if 'hm_geom' in fields:
+            sample['hm_geom'] = self.get_geom_height_map(i, points_source=self.points_source)
+        if 'hm_terrain' in fields:
+            # terrain maps precomputed into the store are reused for training
+            sample['hm_terrain'] = self.get_terrain_height_map(i, cached=True, points_source=self.points_source)
         if self.only_front_cam:
-            mask = self.front_height_map_mask()
-            hm_geom[1] = hm_geom[1] * torch.from_numpy(mask)
-            hm_terrain[1] = hm_terrain[1] * torch.from_numpy(mask)
-        return (imgs, rots, trans, intrins, post_rots, post_trans,
-                hm_geom, hm_terrain,
-                control_ts, controls,
-                traj_ts, Xs, Xds, Rs, Omegas)
+            for name in fields & {'hm_geom', 'hm_terrain'}:
+                sample[name][1] = sample[name][1] * self.front_mask
+        if fields & set(CONTROL_FIELDS):
+            controls = self.get_track_vels(i)
+            assert controls is not None, f'Controls of sample {i} of sequence {self.name} are not available'
+            sample.update(zip(CONTROL_FIELDS, controls))
+        if fields & set(TRAJ_FIELDS):
+            traj_ts, states = self.get_states_traj(i)
+            sample.update(zip(TRAJ_FIELDS, (traj_ts,) + tuple(states)))
+        if 'points' in fields:
+            sample['points'] = torch.as_tensor(position(self.get_cloud(i, points_source=self.points_source))).T
+        # fields loaded together (e.g. trajectory states) are returned only if required
+        return Sample((name, value) for name, value in sample.items() if name in fields)
+
+    def get_sample(self, i):
+        sample = self.get_sample_fields(i, self.fields)
+        if self.fields is None:
+            return tuple(sample.values())
+        return sample
 
 
 class RobinGasPoints(RobinGas):
+    sample_fields = RobinGas.sample_fields + ('points',)
+
     def __init__(self, path, lss_cfg, dphys_cfg=DPhysConfig(), is_train=True,
-                 only_front_cam=False, use_rigid_semantics=True, points_source='lidar'):
+                 only_front_cam=False, use_rigid_semantics=True, points_source='lidar', gpu_img_aug=False,
+                 n_img_threads=4, fields=None):
         super(RobinGasPoints, self).__init__(path, lss_cfg, dphys_cfg=dphys_cfg, is_train=is_train,
-                                             only_front_cam=only_front_cam, use_rigid_semantics=use_rigid_semantics)
+                                             only_front_cam=only_front_cam, use_rigid_semantics=use_rigid_semantics,
+                                             gpu_img_aug=gpu_img_aug, n_img_threads=n_img_threads, fields=fields)
         assert points_source in ['lidar', 'radar', 'lidar_radar']
         self.points_source = points_source
 
-    def get_sample(self, i):
-        imgs, rots, trans, intrins, post_rots, post_trans = self.get_images_data(i)
-        control_ts, controls = self.get_track_vels(i)
-        traj_ts, states = self.get_states_traj(i)
-        Xs, Xds, Rs, Omegas = states
-        hm_geom = self.get_geom_height_map(i, points_source=self.points_source)
-        hm_terrain = self.get_terrain_height_map(i, points_source=self.points_source)
-        if self.only_front_cam:
-            mask = self.front_height_map_mask()
-            hm_geom[1] = hm_geom[1] * torch.from_numpy(mask)
-            hm_terrain[1] = hm_terrain[1] * torch.from_numpy(mask)
-        points = torch.as_tensor(position(self.get_cloud(i, points_source=self.points_source))).T
-        return (imgs, rots, trans, intrins, post_rots, post_trans,
-                hm_geom, hm_terrain,
-                control_ts, controls,
-                traj_ts, Xs, Xds, Rs, Omegas,
-                points)
+
+class RobinGasCached(RobinGas):
+    """
+    RobinGas dataset reading samples compiled in advance with `RobinGas.compile_cache`.
+
+    Images are stored downscaled as uint8 arrays and height maps, controls and trajectory states
+    as fixed-shape arrays in memory-mapped shards, so no files are decoded or parsed to load a sample.
+    Image augmentations are applied the same way as in RobinGas.
+    """
+
+    def __init__(self,
+                 path,
+                 lss_cfg,
+                 dphys_cfg=DPhysConfig(),
+                 is_train=False,
+                 only_front_cam=False,
+                 use_rigid_semantics=True,
+                 cache_dir=None,
+                 gpu_img_aug=False,
+                 n_img_threads=4,
+                 fields=None):
+        super(RobinGasCached, self).__init__(path, lss_cfg, dphys_cfg=dphys_cfg, is_train=is_train,
+                                             only_front_cam=only_front_cam, use_rigid_semantics=use_rigid_semantics,
+                                             gpu_img_aug=gpu_img_aug, n_img_threads=n_img_threads, fields=fields)
+        if cache_dir is None:
+            cache_dir = os.path.join(self.path, 'cache', 'samples')
+        self.cache_dir = cache_dir
+        self.cache = ShardedArrays(cache_dir)
+        meta = self.cache.meta
+        assert tuple(meta['img_size']) == self.get_cache_img_size(), \
+            f'Cache {cache_dir} was compiled for image size {meta["img_size"]}, run RobinGas.compile_cache again'
+        assert meta['use_rigid_semantics'] == use_rigid_semantics, \
+            f'Cache {cache_dir} was compiled with use_rigid_semantics={meta["use_rigid_semantics"]}'
+        for cam in self.camera_names:
+            assert cam in meta['camera_names'], f'Camera {cam} is not in cache {cache_dir}'
+        self.cache_cam_index = {cam: meta['camera_names'].index(cam) for cam in self.camera_names}
+        self.cache_index = {id: k for k, id in enumerate(meta['ids'])}
+
+    def get_cache_i(self, i):
+        return self.cache_index[str(self.ids[i])]
+
+    def get_raw_image(self, i, camera=None, size=None):
+        if camera is None:
+            camera = self.camera_names[0]
+        img = self.cache.get(self.get_cache_i(i), 'imgs')[self.cache_cam_index[camera]]
+        return Image.fromarray(np.asarray(img))
+
+    def get_raw_img_size(self, i=0, cam=None):
+        H, W = self.cache.meta['raw_img_size']
+        return H, W
+
+    def get_image(self, i, camera=None, undistort=False, size=None):
+        assert not undistort, 'Cached images are downscaled and can not be undistorted'
+        return super(RobinGasCached, self).get_image(i, camera, undistort=False, size=size)
+
+    def get_track_vels(self, i):
+        k = self.get_cache_i(i)
+        return np.array(self.cache.get(k, 'control_ts')), np.array(self.cache.get(k, 'controls'))
+
+    def get_states_traj(self, i):
+        k = self.get_cache_i(i)
+        states = tuple(np.array(self.cache.get(k, field)) for field in ['Xs', 'Xds', 'Rs', 'Omegas'])
+        return np.array(self.cache.get(k, 'traj_ts')), states
+
+    def get_geom_height_map(self, i, **kwargs):
+        return torch.from_numpy(np.array(self.cache.get(self.get_cache_i(i), 'hm_geom')))
+
+    def get_terrain_height_map(self, i, **kwargs):
+        return torch.from_numpy(np.array(self.cache.get(self.get_cache_i(i), 'hm_terrain')))
 
 
 def heightmap_demo():
@@ -847,13 +1255,11 @@ def extrinsics_demo():
         robot_frame = 'base_link'
         lidar_frame = 'os_sensor'
 
-        Tr_robot_lidar = ds.calib['transformations'][f'T_{robot_frame}__{lidar_frame}']['data']
-        Tr_robot_lidar = np.asarray(Tr_robot_lidar, dtype=float).reshape((4, 4))
+        Tr_robot_lidar = ds.calib.transform(f'T_{robot_frame}__{lidar_frame}')
 
         cam_poses = []
         for frame in ds.camera_names:
-            T_robot_cam = ds.calib['transformations'][f'T_{robot_frame}__{frame}']['data']
-            T_robot_cam = np.asarray(T_robot_cam, dtype=np.float32).reshape((4, 4))
+            T_robot_cam = ds.calib.transform(f'T_{robot_frame}__{frame}').astype(np.float32)
 
             cam_poses.append(T_robot_cam[np.newaxis])
         cam_poses = np.concatenate(cam_poses, axis=0)
@@ -0,0 +1,72 @@
+import torch
+
+
+__all__ = [
+    'Sample',
+    'SAMPLE_DTYPES',
+    'IMG_FIELDS',
+    'CONTROL_FIELDS',
+    'TRAJ_FIELDS',
+]
+
+
+# fields of the camera inputs of the terrain encoder
+IMG_FIELDS = ('imgs', 'rots', 'trans', 'intrins', 'post_rots', 'post_trans')
+# track velocities and their time stamps
+CONTROL_FIELDS = ('control_ts', 'controls')
+# time stamps and states (positions, velocities, rotations, angular velocities) of the trajectory
+TRAJ_FIELDS = ('traj_ts', 'Xs', 'Xds', 'Rs', 'Omegas')
+
+# dtypes of the fields on the training device, None keeps the collated dtype:
+# images are normalized float or uint8 to be augmented on the device, time stamps are kept in double precision
+SAMPLE_DTYPES = {
+    'imgs': None,
+    'rots': torch.float32,
+    'trans': torch.float32,
+    'intrins': torch.float32,
+    'post_rots': torch.float32,
+    'post_trans': torch.float32,
+    'hm_geom': torch.float32,
+    'hm_terrain': torch.float32,
+    'control_ts': None,
+    'controls': torch.float32,
+    'traj_ts': None,
+    'Xs': torch.float32,
+    'Xds': torch.float32,
+    'Rs': torch.float32,
+    'Omegas': torch.float32,
+    'points': torch.float32,
+    'points_lengths': None,
+}
+
+
+class Sample(dict):
+    """
+    Sample (or batch) of named fields, e.g. `imgs`, `hm_geom`, `controls` or `Xs` (see SAMPLE_DTYPES).
+
+    The fields are accessible as items or attributes (`sample['hm_geom']` or `sample.hm_geom`).
+    The default collate and the DataLoader memory pinning keep the type, so a batch of samples
+    is a Sample of batched fields as well:
+    ```
+    ds = RobinGas(path, lss_cfg=lss_cfg, fields=['imgs', 'rots', 'trans', 'intrins', 'post_rots', 'post_trans',
+                                                 'hm_geom'])
+    for batch in DataLoader(ds, batch_size=4, pin_memory=True):
+        batch = batch.to(device, non_blocking=True)
+        height = batch.hm_geom[:, 0]
+    ```
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(f'Sample has no field {name}')
+
+    def to(self, device, non_blocking=False):
+        """Copy the fields to the device and cast them to their dtypes (SAMPLE_DTYPES)."""
+        sample = Sample()
+        for name, value in self.items():
+            value = torch.as_tensor(value).to(device, non_blocking=non_blocking)
+            dtype = SAMPLE_DTYPES.get(name)
+            sample[name] = value if dtype is None else value.to(dtype)
+        return sample
@@ -0,0 +1,49 @@
+import numpy as np
+from torch.utils.data import Sampler, ConcatDataset
+
+
+__all__ = [
+    'ChunkShuffleSampler',
+]
+
+
+class ChunkShuffleSampler(Sampler):
+    """
+    Sampler shuffling chunks of temporally adjacent samples.
+
+    The samples of each sequence (a dataset of ConcatDataset, or the whole dataset otherwise)
+    are split into chunks of `chunk_size` consecutive indices. The chunks of all sequences are always
+    shuffled every epoch, the samples within a chunk are shuffled as well if `shuffle_within_chunks` is set.
+    A DataLoader batch thus mostly reads neighbouring frames of a single sequence, which are likely
+    in the page cache and share the sequence data already loaded by the worker.
+
+    Example:
+    ```
+    train_ds, val_ds = compile_data(...)
+    loader = DataLoader(train_ds, batch_size=4, sampler=ChunkShuffleSampler(train_ds, chunk_size=32))
+    ```
+    """
+
+    def __init__(self, data_source, chunk_size=32, shuffle_within_chunks=True):
+        assert isinstance(chunk_size, int) and chunk_size > 0
+        self.chunk_size = chunk_size
+        self.shuffle_within_chunks = shuffle_within_chunks
+        if isinstance(data_source, ConcatDataset):
+            ends = list(data_source.cumulative_sizes)
+        else:
+            ends = [len(data_source)]
+        starts = [0] + ends[:-1]
+        self.chunks = [np.arange(s, e)[k:k + chunk_size]
+                       for s, e in zip(starts, ends) for k in range(0, e - s, chunk_size)]
+        self.n_samples = ends[-1] if ends else 0
+
+    def __iter__(self):
+        for c in np.random.permutation(len(self.chunks)):
+            chunk = self.chunks[c]
+            if self.shuffle_within_chunks:
+                chunk = np.random.permutation(chunk)
+            for i in chunk:
+                yield int(i)
+
+    def __len__(self):
+        return self.n_samples
@@ -0,0 +1,401 @@
+import os
+import shutil
+import numpy as np
+from ..cloudproc import PointCloud
+from ..utils import read_yaml, write_to_yaml
+
+
+__all__ = [
+    'ShardedArrayWriter',
+    'ShardedArrays',
+    'TerrainStore',
+    'CloudStoreWriter',
+    'CloudStore',
+]
+
+
+class ShardedArrayWriter:
+    """
+    Writer of fixed-shape per-sample arrays into sharded .npy files.
+
+    The store is written into a temporary directory which replaces `path` on `close()`,
+    so readers never see a partially written store. The store has the following structure:
+    - <path>
+        - index.yaml
+        - <field>_<shard>.npy
+        - ...
+
+    Example:
+    ```
+    writer = ShardedArrayWriter(path, n_samples, fields={'height': ((128, 128), 'float32')})
+    for i in range(n_samples):
+        writer.write(i, {'height': height_i})
+    writer.close()
+    ```
+    """
+
+    def __init__(self, path, n_samples, fields, shard_size=256, meta=None):
+        assert isinstance(n_samples, int) and n_samples > 0
+        assert isinstance(shard_size, int) and shard_size > 0
+        assert isinstance(fields, dict) and len(fields) > 0
+        self.path = os.path.normpath(path)
+        self.tmp_path = self.path + '.tmp'
+        self.n_samples = n_samples
+        self.shard_size = shard_size
+        self.fields = {name: (tuple(shape), np.dtype(dtype)) for name, (shape, dtype) in fields.items()}
+        self.meta = meta if meta is not None else {}
+        self.n_shards = int(np.ceil(n_samples / shard_size))
+        self.shards = {}
+
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+    def get_shard(self, field, shard_i):
+        key = (field, shard_i)
+        if key not in self.shards:
+            shape, dtype = self.fields[field]
+            n = min(self.shard_size, self.n_samples - shard_i * self.shard_size)
+            shard_path = os.path.join(self.tmp_path, '%s_%05d.npy' % (field, shard_i))
+            self.shards[key] = np.lib.format.open_memmap(shard_path, mode='w+', dtype=dtype, shape=(n,) + shape)
+        return self.shards[key]
+
+    def write(self, i, sample):
+        assert 0 <= i < self.n_samples, 'Sample index %i out of range' % i
+        assert set(sample.keys()) == set(self.fields.keys()), 'Sample fields %s differ from %s' % (
+            sorted(sample.keys()), sorted(self.fields.keys()))
+        shard_i, k = divmod(i, self.shard_size)
+        for field, value in sample.items():
+            shard = self.get_shard(field, shard_i)
+            assert tuple(np.shape(value)) == shard.shape[1:], 'Field %s has shape %s, expected %s' % (
+                field, np.shape(value), shard.shape[1:])
+            shard[k] = value
+        # release finished shards
+        if k == self.shard_size - 1 or i == self.n_samples - 1:
+            for field in self.fields:
+                self.close_shard(field, shard_i)
+
+    def close_shard(self, field, shard_i):
+        shard = self.shards.pop((field, shard_i), None)
+        if shard is not None:
+            shard.flush()
+            del shard
+
+    def close(self):
+        for field, shard_i in list(self.shards.keys()):
+            self.close_shard(field, shard_i)
+        index = {
+            'n_samples': self.n_samples,
+            'shard_size': self.shard_size,
+            'fields': {name: {'shape': list(shape), 'dtype': dtype.str} for name, (shape, dtype) in self.fields.items()},
+            'meta': self.meta,
+        }
+        write_to_yaml(index, os.path.join(self.tmp_path, 'index.yaml'))
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+
+class ShardedArrays:
+    """
+    Reader of stores written with ShardedArrayWriter.
+
+    Shards are memory-mapped when first accessed, so the reader is cheap to create and
+    can be shared by DataLoader workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index_path = os.path.join(path, 'index.yaml')
+        assert os.path.exists(index_path), f'Sample store {path} does not exist'
+        index = read_yaml(index_path)
+        self.n_samples = index['n_samples']
+        self.shard_size = index['shard_size']
+        self.fields = {name: (tuple(f['shape']), np.dtype(f['dtype'])) for name, f in index['fields'].items()}
+        self.meta = index['meta']
+        self.shards = {}
+
+    def get_shard(self, field, shard_i):
+        key = (field, shard_i)
+        if key not in self.shards:
+            shard_path = os.path.join(self.path, '%s_%05d.npy' % (field, shard_i))
+            self.shards[key] = np.load(shard_path, mmap_mode='r')
+        return self.shards[key]
+
+    def get(self, i, field):
+        """Read-only view of a field of the i-th sample."""
+        assert 0 <= i < self.n_samples, 'Sample index %i out of range' % i
+        shard_i, k = divmod(i, self.shard_size)
+        return self.get_shard(field, shard_i)[k]
+
+    def __getitem__(self, i):
+        return {field: self.get(i, field) for field in self.fields}
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getstate__(self):
+        # memory maps are reopened in worker processes
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+
+class TerrainStore:
+    """
+    Per-sequence store of height maps with float16 heights and bit-packed masks.
+
+    Height maps are indexed by sample ids and written lazily into memory-mapped arrays.
+    Written samples are flushed every `flush_every` puts (and on `flush()`) and marked valid
+    only after their data is flushed, unflushed samples are estimated again by other processes.
+    The store directory is created
+    atomically, so concurrent DataLoader workers may fill it. The store has the following structure:
+    - <path>
+        - ids.npy (N)
+        - height.npy (N x H x W), float16
+        - mask.npy (N x ceil(H * W / 8)), uint8
+        - valid.npy (N), uint8
+    """
+
+    def __init__(self, path, ids, flush_every=64):
+        self.path = os.path.normpath(path)
+        self.ids = np.asarray(ids, dtype=str)
+        self.flush_every = flush_every
+        self.index = None
+        self.shape = None
+        self.arrays = None
+        self.mode = None
+        # written samples not yet flushed and marked valid
+        self.pending = set()
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'valid.npy'))
+
+    def create(self, shape):
+        tmp_path = self.path + '.tmp%d' % os.getpid()
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        n, n_bytes = len(self.ids), int(np.ceil(np.prod(shape) / 8))
+        np.save(os.path.join(tmp_path, 'ids.npy'), self.ids)
+        for name, dtype, field_shape in [('height', np.float16, (n,) + tuple(shape)),
+                                         ('mask', np.uint8, (n, n_bytes)),
+                                         ('valid', np.uint8, (n,))]:
+            arr = np.lib.format.open_memmap(os.path.join(tmp_path, f'{name}.npy'), mode='w+',
+                                            dtype=dtype, shape=field_shape)
+            arr.flush()
+            del arr
+        try:
+            # fails if another process has already created the store
+            os.rename(tmp_path, self.path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+
+    def open(self, mode='r'):
+        if self.arrays is not None and (self.mode == mode or mode == 'r'):
+            return True
+        if not self.exists():
+            return False
+        self.arrays = {name: np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode=mode)
+                       for name in ['height', 'mask', 'valid']}
+        self.mode = mode
+        self.shape = self.arrays['height'].shape[1:]
+        ids = np.load(os.path.join(self.path, 'ids.npy'))
+        self.index = {id: k for k, id in enumerate(ids)}
+        return True
+
+    def get(self, id):
+        """Height map (2 x H x W) with height and mask channels or None if it is not stored."""
+        if not self.open():
+            return None
+        k = self.index.get(str(id))
+        if k is None or not (self.arrays['valid'][k] or k in self.pending):
+            return None
+        height = np.asarray(self.arrays['height'][k], dtype=np.float32)
+        mask = np.unpackbits(self.arrays['mask'][k], count=height.size).reshape(height.shape)
+        return np.stack([height, mask.astype(np.float32)])
+
+    def put(self, id, height, mask):
+        """Store height map layers and return the stored height map (2 x H x W)."""
+        height = np.asarray(height)
+        if not self.exists():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.create(height.shape)
+        self.open(mode='r+')
+        assert height.shape == self.shape, f'Height map shape {height.shape} differs from stored {self.shape}'
+        k = self.index.get(str(id))
+        assert k is not None, f'Sample {id} is not indexed in the terrain store {self.path}'
+        self.arrays['height'][k] = height
+        self.arrays['mask'][k] = np.packbits(np.asarray(mask).ravel() > 0)
+        self.pending.add(k)
+        # flushing the whole memory maps is expensive for large stores
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+        return self.get(id)
+
+    def flush(self):
+        """Flush the written height maps and mark them valid."""
+        if not self.pending or self.arrays is None:
+            return
+        self.arrays['height'].flush()
+        self.arrays['mask'].flush()
+        self.arrays['valid'][sorted(self.pending)] = 1
+        self.arrays['valid'].flush()
+        self.pending.clear()
+
+    def __del__(self):
+        self.flush()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        # memory maps are reopened in worker processes
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        state['mode'] = None
+        state['pending'] = set()
+        return state
+
+
+class CloudStoreWriter:
+    """
+    Writer of per-sequence point clouds into one file with quantized coordinates.
+
+    Point positions are stored as int16 multiples of `resolution` and optionally the float16 point
+    intensities, other point fields are not stored. Points out of the representable range
+    (about 163 m with the default resolution) are dropped and counted in `n_dropped`. Clouds of the samples are
+    appended one after another and indexed with offsets. The store is written into a temporary
+    directory which replaces `path` on `close()`. The store has the following structure:
+    - <path>
+        - index.yaml
+        - ids.npy (N)
+        - offsets.npy (N + 1)
+        - xyz.bin (M x 3), int16
+        - intensity.bin (M), float16
+
+    Example:
+    ```
+    writer = CloudStoreWriter(path, resolution=0.005)
+    for id, points in zip(ids, clouds):
+        writer.write(id, points)
+    writer.close()
+    ```
+    """
+
+    def __init__(self, path, resolution=0.005, intensity=False):
+        assert resolution > 0
+        self.path = os.path.normpath(path)
+        self.tmp_path = self.path + '.tmp'
+        self.resolution = resolution
+        self.intensity = intensity
+        self.ids = []
+        self.offsets = [0]
+        self.n_dropped = 0
+
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.xyz_file = open(os.path.join(self.tmp_path, 'xyz.bin'), 'wb')
+        self.intensity_file = open(os.path.join(self.tmp_path, 'intensity.bin'), 'wb') if intensity else None
+
+    def write(self, id, points, intensity=None):
+        """Append points (N x 3) of the sample `id` and their intensities (N) if the store has them."""
+        points = np.asarray(points).reshape((-1, 3))
+        q = np.round(points / self.resolution)
+        limit = np.iinfo(np.int16).max
+        valid = np.all(np.isfinite(q) & (np.abs(q) <= limit), axis=1)
+        self.xyz_file.write(q[valid].astype(np.int16).tobytes())
+        if self.intensity_file is not None:
+            assert intensity is not None, 'Intensity of points is required'
+            intensity = np.asarray(intensity).reshape((-1,))[valid]
+            self.intensity_file.write(intensity.astype(np.float16).tobytes())
+        self.ids.append(str(id))
+        self.offsets.append(self.offsets[-1] + int(valid.sum()))
+        self.n_dropped += len(valid) - int(valid.sum())
+
+    def close(self):
+        self.xyz_file.close()
+        if self.intensity_file is not None:
+            self.intensity_file.close()
+        np.save(os.path.join(self.tmp_path, 'ids.npy'), np.asarray(self.ids, dtype=str))
+        np.save(os.path.join(self.tmp_path, 'offsets.npy'), np.asarray(self.offsets, dtype=np.int64))
+        index = {
+            'n_samples': len(self.ids),
+            'n_points': self.offsets[-1],
+            'resolution': float(self.resolution),
+            'intensity': bool(self.intensity),
+            'n_dropped': self.n_dropped,
+        }
+        if self.n_dropped > 0:
+            print(f'{self.n_dropped} points out of the range of {np.iinfo(np.int16).max * self.resolution:.1f} m '
+                  f'or not finite were not stored in {self.path}')
+        write_to_yaml(index, os.path.join(self.tmp_path, 'index.yaml'))
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+
+class CloudStore:
+    """
+    Reader of stores written with CloudStoreWriter.
+
+    The point files are memory-mapped when first accessed and the clouds are returned
+    as PointCloud with float32 fields x, y, z (and intensity).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index_path = os.path.join(path, 'index.yaml')
+        assert os.path.exists(index_path), f'Cloud store {path} does not exist'
+        index = read_yaml(index_path)
+        self.n_points = index['n_points']
+        self.resolution = index['resolution']
+        self.intensity = index['intensity']
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.index = {id: k for k, id in enumerate(np.load(os.path.join(path, 'ids.npy')))}
+        self.fields = ('x', 'y', 'z', 'intensity') if self.intensity else ('x', 'y', 'z')
+        self.arrays = None
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'index.yaml'))
+
+    def open(self):
+        if self.arrays is None:
+            # np.memmap does not map empty files
+            n = self.n_points
+            self.arrays = {'xyz': np.memmap(os.path.join(self.path, 'xyz.bin'), dtype=np.int16, mode='r',
+                                            shape=(n, 3)) if n > 0 else np.zeros((0, 3), dtype=np.int16)}
+            if self.intensity:
+                self.arrays['intensity'] = np.memmap(os.path.join(self.path, 'intensity.bin'), dtype=np.float16,
+                                                     mode='r', shape=(n,)) if n > 0 else np.zeros(0, dtype=np.float16)
+
+    def get_points(self, id):
+        """Point positions (N x 3) of the sample or None if it is not stored."""
+        k = self.index.get(str(id))
+        if k is None:
+            return None
+        self.open()
+        start, end = self.offsets[k], self.offsets[k + 1]
+        return self.arrays['xyz'][start:end].astype(np.float32) * np.float32(self.resolution)
+
+    def get(self, id):
+        """Cloud (PointCloud) of the sample or None if it is not stored."""
+        points = self.get_points(id)
+        if points is None:
+            return None
+        if self.intensity:
+            k = self.index[str(id)]
+            intensity = self.arrays['intensity'][self.offsets[k]:self.offsets[k + 1]].astype(np.float32)
+            points = np.concatenate([points, intensity[:, None]], axis=1)
+        return PointCloud(points, self.fields)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # memory maps are reopened in worker processes
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
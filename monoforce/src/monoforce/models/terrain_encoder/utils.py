@@ -66,6 +66,13 @@ def img_transform(img, post_rot, post_tran,
         img = img.transpose(method=Image.FLIP_LEFT_RIGHT)
     img = img.rotate(rotate)
 
+    post_rot, post_tran = img_transform_matrices(post_rot, post_tran, resize=resize, crop=crop,
+                                                 flip=flip, rotate=rotate)
+
+    return img, post_rot, post_tran
+
+
+def img_transform_matrices(post_rot, post_tran, resize, crop, flip, rotate):
     # post-homography transformation
     post_rot *= resize
     post_tran -= torch.Tensor(crop[:2])
@@ -80,7 +87,7 @@ def img_transform(img, post_rot, post_tran,
     post_rot = A.matmul(post_rot)
     post_tran = A.matmul(post_tran) + b
 
-    return img, post_rot, post_tran
+    return post_rot, post_tran
 
 
 class NormalizeInverse(torchvision.transforms.Normalize):
@@ -112,6 +119,70 @@ normalize_img = torchvision.transforms.Compose((
 ))
 
 
+def augment_imgs(imgs, post_rots, post_trans, raw_size, final_dim, photometric=False):
+    """
+    Batched version of `img_transform` and `normalize_img` running on the device of the images.
+
+    The images are warped with the post-homography (post_rots, post_trans), which maps raw image pixels
+    to the augmented image pixels, so any image resolution with the raw aspect ratio can be used.
+    :param imgs: uint8 images (B x N x H x W x 3) with values 0..255
+    :param post_rots: post rotations (B x N x 3 x 3)
+    :param post_trans: post translations (B x N x 3)
+    :param raw_size: (H, W) of raw images
+    :param final_dim: (H, W) of augmented images
+    :param photometric: apply random brightness, contrast, gamma and noise augmentations
+    :return: normalized images (B x N x 3 x H x W)
+    """
+    B, N, H, W, _ = imgs.shape
+    fH, fW = final_dim
+    rH, rW = raw_size
+    device = imgs.device
+    imgs = imgs.reshape((B * N, H, W, 3)).permute(0, 3, 1, 2).float() / 255.
+    R = post_rots.reshape((B * N, 3, 3))[:, :2, :2].float()
+    t = post_trans.reshape((B * N, 3))[:, None, :2].float()
+
+    # pixel centers of augmented images in raw image coordinates
+    v, u = torch.meshgrid(torch.arange(fH, device=device) + 0.5, torch.arange(fW, device=device) + 0.5,
+                          indexing='ij')
+    uv = torch.stack([u, v], dim=-1).reshape((1, -1, 2))
+    uv = (uv - t) @ torch.linalg.inv(R).transpose(1, 2)
+    grid = uv / torch.as_tensor([rW, rH], dtype=uv.dtype, device=device) * 2 - 1
+    imgs = torch.nn.functional.grid_sample(imgs, grid.reshape((B * N, fH, fW, 2)),
+                                           mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    if photometric:
+        imgs = photometric_augment(imgs)
+    imgs = (imgs - torch.as_tensor(mean, device=device).view(1, 3, 1, 1)) / \
+           torch.as_tensor(std, device=device).view(1, 3, 1, 1)
+
+    return imgs.reshape((B, N, 3, fH, fW))
+
+
+def photometric_augment(imgs, p=0.5, brightness_limit=0.2, contrast_limit=0.2, gamma_limit=(80, 120),
+                        var_limit=(10, 50)):
+    """
+    Random brightness and contrast, gamma and Gaussian noise (as in albumentations) applied to every image
+    of the batch (B x 3 x H x W) with values 0..1 independently with probability `p`.
+    """
+    B = imgs.shape[0]
+    device = imgs.device
+
+    def rand(low, high):
+        return torch.empty((B, 1, 1, 1), device=device).uniform_(low, high)
+
+    def apply():
+        return torch.rand((B, 1, 1, 1), device=device) < p
+
+    alpha = 1. + rand(-contrast_limit, contrast_limit)
+    beta = rand(-brightness_limit, brightness_limit)
+    imgs = torch.where(apply(), imgs * alpha + beta, imgs).clamp(0, 1)
+    gamma = rand(*gamma_limit) / 100.
+    imgs = torch.where(apply(), imgs ** gamma, imgs)
+    sigma = rand(*var_limit).sqrt() / 255.
+    imgs = torch.where(apply(), imgs + sigma * torch.randn_like(imgs), imgs).clamp(0, 1)
+    return imgs
+
+
 def sample_augmentation(lss_cfg, is_train=False):
     H, W = lss_cfg['data_aug_conf']['H'], lss_cfg['data_aug_conf']['W']
     fH, fW = lss_cfg['data_aug_conf']['final_dim']
@@ -1,43 +1,96 @@
 from __future__ import absolute_import, division, print_function
 import numpy as np
 import torch
-from numpy.lib.recfunctions import structured_to_unstructured
 from scipy.spatial.transform import Rotation
+from .cloudproc import position, PointCloud
 
 
 __all__ = [
     'transform_cloud',
+    'transform_clouds',
     'xyz_rpy_to_matrix',
     'rot2rpy',
     'rpy2rot',
     'pose_to_xyz_q',
+    'so3_log',
+    'poses_to_states',
 ]
 
 
-def position(cloud):
-    """Cloud to point positions (xyz)."""
-    if cloud.dtype.names:
-        x = structured_to_unstructured(cloud[['x', 'y', 'z']])
-    else:
-        x = cloud
-    return x
-
+def transform_cloud(cloud, Tr, inplace=False):
+    """
+    Apply a rigid transform (4 x 4) to a cloud.
 
-def transform_cloud(cloud, Tr):
-    assert isinstance(cloud, np.ndarray) or isinstance(cloud, torch.Tensor), type(cloud)
+    The result keeps the floating dtype of the cloud (the transform is cast to it), integer clouds
+    are transformed to float32, and is contiguous. With `inplace=True` the cloud itself is modified,
+    which requires a floating dtype.
+    """
+    assert isinstance(cloud, (np.ndarray, torch.Tensor, PointCloud)), type(cloud)
     assert isinstance(Tr, np.ndarray) or isinstance(Tr, torch.Tensor), type(Tr)
+    if isinstance(cloud, PointCloud):
+        return cloud.transform(Tr, inplace=inplace)
     if isinstance(cloud, np.ndarray) and cloud.dtype.names is not None:
-        points = position(cloud)
-        points = transform_cloud(points, Tr)
-        cloud = cloud.copy()
+        assert all(np.issubdtype(cloud.dtype[f], np.floating) for f in ['x', 'y', 'z']), \
+            'Structured clouds with integer coordinates can not be transformed'
+        # position may be a view of the cloud, the input cloud is modified only with inplace=True
+        points = transform_cloud(position(cloud), Tr)
+        if not inplace:
+            cloud = cloud.copy()
         cloud['x'] = points[:, 0]
         cloud['y'] = points[:, 1]
         cloud['z'] = points[:, 2]
         return cloud
     assert cloud.ndim == 2
     assert cloud.shape[1] == 3  # (N, 3)
-    cloud_tr = Tr[:3, :3] @ cloud.T + Tr[:3, 3:]
-    return cloud_tr.T
+    if isinstance(cloud, torch.Tensor):
+        is_float = cloud.is_floating_point()
+    else:
+        is_float = np.issubdtype(cloud.dtype, np.floating)
+    # the transformed coordinates of integer clouds would be truncated
+    assert is_float or not inplace, f'Cloud of dtype {cloud.dtype} can not be transformed in place'
+    if isinstance(cloud, torch.Tensor):
+        if not is_float:
+            cloud = cloud.to(torch.float32)
+        Tr = torch.as_tensor(Tr, dtype=cloud.dtype, device=cloud.device)
+        cloud_tr = cloud @ Tr[:3, :3].T + Tr[:3, 3]
+    else:
+        if isinstance(Tr, torch.Tensor):
+            Tr = Tr.detach().cpu().numpy()
+        if not is_float:
+            cloud = cloud.astype(np.float32)
+        Tr = np.asarray(Tr, dtype=cloud.dtype)
+        cloud_tr = cloud @ Tr[:3, :3].T
+        cloud_tr += Tr[:3, 3]
+    if inplace:
+        cloud[...] = cloud_tr
+        return cloud
+    return cloud_tr
+
+
+def transform_clouds(poses, points, out=None):
+    """
+    Transform template points (N x 3) by a batch of poses (T x 4 x 4).
+
+    @param poses: poses (T x 4 x 4), cast to the dtype of the points.
+    @param points: points (N x 3).
+    @param out: optional contiguous output buffer (T x N x 3).
+    @return: transformed points (T x N x 3).
+    """
+    assert isinstance(points, (np.ndarray, torch.Tensor)), type(points)
+    assert points.ndim == 2 and points.shape[1] == 3, 'Invalid points shape %s' % (tuple(points.shape),)
+    assert poses.ndim == 3 and poses.shape[1:] == (4, 4), 'Invalid poses shape %s' % (tuple(poses.shape),)
+    if isinstance(points, torch.Tensor):
+        poses = torch.as_tensor(poses, dtype=points.dtype, device=points.device)
+        out = torch.matmul(points, poses[:, :3, :3].transpose(1, 2), out=out)
+    else:
+        if isinstance(poses, torch.Tensor):
+            poses = poses.detach().cpu().numpy()
+        if not np.issubdtype(points.dtype, np.floating):
+            points = points.astype(np.float32)
+        poses = np.asarray(poses, dtype=points.dtype)
+        out = np.einsum('tij,nj->tni', poses[:, :3, :3], points, out=out)
+    out += poses[:, None, :3, 3]
+    return out
 
 def xyz_rpy_to_matrix(xyz_rpy):
     t = xyz_rpy[:3]
@@ -85,3 +138,46 @@ def pose_to_xyz_q(pose):
     quat = torch.as_tensor(quat)
     xyz_q = torch.cat([xyz, quat])
     return xyz_q
+
+
+def so3_log(R):
+    """Rotation vectors (... x 3) of rotation matrices (... x 3 x 3), the logarithm map of SO(3)."""
+    R = np.asarray(R)
+    assert R.shape[-2:] == (3, 3), 'Invalid rotations shape %s' % (R.shape,)
+    rotvec = Rotation.from_matrix(R.reshape((-1, 3, 3))).as_rotvec()
+    return rotvec.reshape(R.shape[:-2] + (3,)).astype(R.dtype)
+
+
+def poses_to_states(poses, stamps, body_frame=False):
+    """
+    Rigid body states of trajectories of poses (... x T x 4 x 4) with time stamps (... x T).
+
+    Velocities are finite differences of consecutive poses, angular velocities are the SO(3) logarithms
+    of the relative rotations. The last state and states with non-increasing time stamps have zero velocities.
+    @param body_frame: velocities in the frames of the poses, otherwise in the frame the poses are expressed in,
+                       as the DPhysics states (xd = dx/dt, dR/dt = [omega]_x R)
+    @return: positions (... x T x 3), velocities (... x T x 3), rotations (... x T x 3 x 3),
+             angular velocities (... x T x 3)
+    """
+    poses = np.asarray(poses)
+    stamps = np.asarray(stamps)
+    assert poses.shape[-2:] == (4, 4), 'Invalid poses shape %s' % (poses.shape,)
+    assert stamps.shape == poses.shape[:-2], 'Stamps shape %s differs from poses %s' % (stamps.shape, poses.shape)
+    xs = poses[..., :3, 3]
+    Rs = poses[..., :3, :3]
+
+    dxs = np.diff(xs, axis=-2)
+    if body_frame:
+        dRs = np.swapaxes(Rs[..., :-1, :, :], -1, -2) @ Rs[..., 1:, :, :]
+        dxs = np.einsum('...ji,...j->...i', Rs[..., :-1, :, :], dxs)
+    else:
+        dRs = Rs[..., 1:, :, :] @ np.swapaxes(Rs[..., :-1, :, :], -1, -2)
+    dts = np.diff(stamps, axis=-1)[..., None]
+    valid = dts > 0
+
+    xds = np.zeros_like(xs)
+    omegas = np.zeros_like(xs)
+    xds[..., :-1, :] = np.divide(dxs, dts, out=np.zeros_like(dxs), where=valid)
+    omegas[..., :-1, :] = np.divide(so3_log(dRs), dts, out=np.zeros_like(dxs), where=valid)
+
+    return xs, xds, Rs, omegas
@@ -7,6 +7,7 @@ from numpy.lib.recfunctions import structured_to_unstructured
 from timeit import default_timer as timer
 import torch
 import yaml
+from .cloudproc import position
 
 
 __all__ = [
@@ -17,8 +18,12 @@ __all__ = [
     'read_yaml',
     'write_to_yaml',
     'str2bool',
+    'mtimes',
     'position',
     'color',
+    'nearest_index',
+    'interp_windows',
+    'Calibration',
     'load_calib',
     'compile_data',
     'explore_data'
@@ -79,13 +84,10 @@ def write_to_yaml(cfg: dict, path):
 def str2bool(v):
     return v.lower() in ('1', 'yes', 'true', 't', 'y')
 
-def position(cloud):
-    """Cloud to point positions (xyz)."""
-    if cloud.dtype.names:
-        x = structured_to_unstructured(cloud[['x', 'y', 'z']])
-    else:
-        x = cloud
-    return x
+def mtimes(paths):
+    """Modification times of files and directories (None if missing), changed when they are rewritten."""
+    return tuple(os.path.getmtime(p) if os.path.exists(p) else None for p in paths)
+
 
 def color(cloud):
     """Color to rgb."""
@@ -96,8 +98,118 @@ def color(cloud):
     return rgb
 
 
+def nearest_index(stamps, t):
+    """Indices of the closest values in sorted `stamps` to `t` (scalar or array), ties go left."""
+    stamps = np.asarray(stamps)
+    if len(stamps) == 1:
+        return np.zeros_like(np.searchsorted(stamps, t))
+    i = np.searchsorted(stamps, t)
+    i = np.clip(i, 1, len(stamps) - 1)
+    i = i - ((t - stamps[i - 1]) <= (stamps[i] - t))
+    return i
+
+
+def interp_windows(t, stamps, values, il, ir):
+    """
+    Linear interpolation of `values` (N x C) sampled at sorted `stamps` (N) at times `t` (M x T),
+    each row restricted to the window stamps[il:ir] and clamped to its ends like np.interp.
+    :return: interpolated values (M x T x C)
+    """
+    lo = np.asarray(il).reshape((-1, 1))
+    hi = np.maximum(np.asarray(ir).reshape((-1, 1)) - 1, lo)
+    k0 = np.clip(np.searchsorted(stamps, t, side='right') - 1, lo, hi)
+    k1 = np.minimum(k0 + 1, hi)
+    t0, t1 = stamps[k0], stamps[k1]
+    w = np.divide(t - t0, t1 - t0, out=np.zeros(np.shape(t)), where=t1 > t0).clip(0, 1)[..., None]
+    return values[k0] * (1 - w) + values[k1] * w
+
+
+class Calibration(dict):
+    """
+    Calibration loaded by `load_calib`: the parsed YAML files (camera calibrations by camera name,
+    'transformations' and 'clearance') and the camera parameters compiled once:
+    - cameras: names of the calibrated cameras,
+    - Ks: intrinsics (N x 3 x 3),
+    - Es: robot-camera extrinsics T_<robot_frame>__<camera> (N x 4 x 4), NaN if the transformation is missing
+      (`get_camera` raises KeyError for such cameras),
+    - Ds: distortion coefficients of the cameras (the number of coefficients depends on the camera model).
+
+    Example:
+    ```
+    calib = load_calib(calib_path)
+    E, K, D = calib.get_camera('camera_front')
+    Ks = calib.Ks[calib.camera_indices(['camera_front', 'camera_left'])]
+    T = calib.transform('T_base_link__os_sensor')
+    ```
+    """
+
+    def __init__(self, cameras, transformations, robot_frame='base_link'):
+        """
+        :param cameras: dict camera name -> parsed camera calibration (camera_matrix, distortion_coefficients)
+        :param transformations: parsed transformations, dict T_<frame>__<frame> -> {'data': [...]}
+        """
+        super(Calibration, self).__init__(cameras)
+        self['transformations'] = transformations
+        self.transforms = {}
+        self['clearance'] = np.abs(self.transform('T_base_link__base_footprint')[2, 3])
+
+        self.robot_frame = robot_frame
+        self.cameras = sorted(cameras.keys())
+        self.camera_ids = {cam: k for k, cam in enumerate(self.cameras)}
+        self.Ks = np.stack([np.asarray(cameras[cam]['camera_matrix']['data'], dtype=np.float32).reshape((3, 3))
+                            for cam in self.cameras]) if self.cameras else np.zeros((0, 3, 3), dtype=np.float32)
+        self.Es = np.full((len(self.cameras), 4, 4), np.nan, dtype=np.float32)
+        for k, cam in enumerate(self.cameras):
+            if f'T_{robot_frame}__{cam}' in transformations:
+                self.Es[k] = self.transform(f'T_{robot_frame}__{cam}')
+        self.Ds = [np.asarray(cameras[cam]['distortion_coefficients']['data'], dtype=np.float32)
+                   for cam in self.cameras]
+        # shared by the datasets of a sequence
+        for array in [self.Ks, self.Es] + self.Ds:
+            array.flags.writeable = False
+
+    def transform(self, name):
+        """Transformation matrix (4 x 4) by name, e.g. T_base_link__os_sensor, parsed on the first use."""
+        if name not in self.transforms:
+            T = np.asarray(self['transformations'][name]['data'], dtype=float).reshape((4, 4))
+            T.flags.writeable = False
+            self.transforms[name] = T
+        return self.transforms[name]
+
+    def camera_index(self, camera, fuzzy=False):
+        """
+        Index of the camera by its calibrated name.
+        :param fuzzy: if the name is not calibrated, use the first calibrated camera containing it
+        """
+        if camera in self.camera_ids:
+            return self.camera_ids[camera]
+        matches = [k for k, cam in enumerate(self.cameras) if camera in cam] if fuzzy else []
+        if len(matches) == 0:
+            raise KeyError(f'Camera {camera} is not calibrated, calibrated cameras are {self.cameras}')
+        return matches[0]
+
+    def camera_indices(self, cameras):
+        return np.asarray([self.camera_index(cam) for cam in cameras], dtype=int)
+
+    def get_camera(self, camera, robot_frame=None):
+        """
+        Camera calibration parameters.
+        :return: E - extrinsics (4x4),
+                 K - intrinsics (3x3),
+                 D - distortion coefficients
+        """
+        k = self.camera_index(camera)
+        if robot_frame is None or robot_frame == self.robot_frame:
+            E = self.Es[k]
+            if not np.isfinite(E).all():
+                raise KeyError(f'Transformation T_{self.robot_frame}__{self.cameras[k]} is not calibrated')
+        else:
+            E = self.transform(f'T_{robot_frame}__{self.cameras[k]}').astype(np.float32)
+        return E, self.Ks[k], self.Ds[k]
+
+
 def load_calib(calib_path):
-    calib = {}
+    cameras = {}
     # read camera calibration
     cams_path = os.path.join(calib_path, 'cameras')
     if not os.path.exists(cams_path):
@@ -107,25 +219,20 @@ def load_calib(calib_path):
     for file in os.listdir(cams_path):
         if file.endswith('.yaml'):
             with open(os.path.join(cams_path, file), 'r') as f:
-                cam_info = yaml.load(f, Loader=yaml.FullLoader)
-                calib[file.replace('.yaml', '')] = cam_info
-            f.close()
+                cameras[file.replace('.yaml', '')] = yaml.load(f, Loader=yaml.FullLoader)
     # read cameras-lidar transformations
     trans_path = os.path.join(calib_path, 'transformations.yaml')
     with open(trans_path, 'r') as f:
         transforms = yaml.load(f, Loader=yaml.FullLoader)
-    f.close()
-    calib['transformations'] = transforms
-    T = np.asarray(calib['transformations']['T_base_link__base_footprint']['data'], dtype=np.float32).reshape((4, 4))
-    calib['clearance'] = np.abs(T[2, 3])
 
-    return calib
+    return Calibration(cameras, transforms)
 
 
-def compile_data(dataset, robot, lss_cfg, dphys_cfg, val_fraction=0.1, small_data=False, vis=False, **kwargs):
+def compile_data(dataset, robot, lss_cfg, dphys_cfg, val_fraction=0.1, small_data=False, vis=False, cached=False,
+                 **kwargs):
     from torch.utils.data import ConcatDataset, Subset
     from monoforce.datasets import Rellis3D, Rellis3DPoints, rellis3d_seq_paths
-    from monoforce.datasets import RobinGas, RobinGasPoints, robingas_seq_paths
+    from monoforce.datasets import RobinGas, RobinGasPoints, RobinGasCached, robingas_seq_paths
     """
     Compile datasets for LSS model training
 
@@ -136,6 +243,7 @@ def compile_data(dataset, robot, lss_cfg, dphys_cfg, val_fraction=0.1, small_dat
     :param val_fraction: float, fraction of the dataset to use for validation
     :param small_data: bool, debug mode: use small datasets
     :param vis: bool, visualize training samples
+    :param cached: bool, read samples precompiled with RobinGas.compile_cache
     :param kwargs: additional arguments
 
     :return: train_ds, val_ds
@@ -147,11 +255,12 @@ def compile_data(dataset, robot, lss_cfg, dphys_cfg, val_fraction=0.1, small_dat
         DataVis = Rellis3DPoints
         data_paths = rellis3d_seq_paths
     elif dataset == 'robingas':
-        Data = RobinGas
+        Data = RobinGasCached if cached else RobinGas
         DataVis = RobinGasPoints
         data_paths = robingas_seq_paths[robot]
     else:
         raise ValueError(f'Unknown dataset: {dataset}. Supported datasets are rellis3d and robingas.')
+    assert not cached or dataset == 'robingas', 'Cached samples are supported only for robingas dataset'
     print('Data paths:', data_paths)
     for path in data_paths:
         assert os.path.exists(path)
@@ -159,7 +268,9 @@ def compile_data(dataset, robot, lss_cfg, dphys_cfg, val_fraction=0.1, small_dat
         val_ds = Data(path, is_train=False, lss_cfg=lss_cfg, dphys_cfg=dphys_cfg, **kwargs)
 
         if vis:
-            train_ds_vis = DataVis(path, is_train=True, lss_cfg=lss_cfg, dphys_cfg=dphys_cfg, **kwargs)
+            # visualized samples contain normalized images and all fields
+            kwargs_vis = {k: v for k, v in kwargs.items() if k not in ['gpu_img_aug', 'fields']}
+            train_ds_vis = DataVis(path, is_train=True, lss_cfg=lss_cfg, dphys_cfg=dphys_cfg, **kwargs_vis)
             explore_data(train_ds_vis)
 
         # randomly select a subset of the dataset
@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+from monoforce.cloudproc import PointCloud, estimate_heightmap, filter_grid, grid_keys, rasterize_footprints, \
+    segment_ground
+
+
+def random_cloud(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-2., 2., size=(n, 3)).astype(np.float32)
+
+
+def cell_index(points, grid_res):
+    return np.floor(points / grid_res).astype(int)
+
+
+def test_grid_keys():
+    points = random_cloud()
+    keys = grid_keys(points, 0.1)
+    cells = cell_index(points, 0.1)
+    # equal keys of the points in the same cell only
+    _, inv_keys = np.unique(keys, return_inverse=True)
+    _, inv_cells = np.unique(cells, axis=0, return_inverse=True)
+    assert np.array_equal(inv_keys.ravel()[:, None] == inv_keys.ravel()[None],
+                          inv_cells.ravel()[:, None] == inv_cells.ravel()[None])
+    with pytest.raises(AssertionError):
+        grid_keys(np.array([[np.nan, 0., 0.]]), 0.1)
+
+
+@pytest.mark.parametrize('keep', ['first', 'random', 'last', 'centroid'])
+def test_filter_grid(keep):
+    points = random_cloud()
+    points0 = points.copy()
+    filtered = filter_grid(points, 0.5, keep=keep)
+    assert np.array_equal(points, points0)
+    # one point per occupied cell
+    cells = cell_index(points, 0.5)
+    n_cells = len(np.unique(cells, axis=0))
+    assert len(filtered) == n_cells
+    if keep == 'centroid':
+        for p in filtered:
+            in_cell = np.all(cells == cell_index(p[None], 0.5), axis=1)
+            assert np.allclose(p, points[in_cell].mean(axis=0), atol=1e-5)
+    else:
+        assert len(np.unique(cell_index(filtered, 0.5), axis=0)) == n_cells
+        assert set(map(tuple, filtered)) <= set(map(tuple, points))
+    if keep == 'first':
+        ind = filter_grid(points, 0.5, keep=keep, only_mask=True)
+        assert np.array_equal(points[ind], filtered)
+        assert np.all([np.flatnonzero(np.all(cells == cells[k], axis=1))[0] == k for k in ind])
+
+
+@pytest.mark.parametrize('keep', ['first', 'random', 'last', 'centroid'])
+def test_filter_grid_nan(keep):
+    points = random_cloud(100)
+    points[::3, 1] = np.nan
+    points0 = points.copy()
+    filtered = filter_grid(points, 0.5, keep=keep)
+    assert np.array_equal(points, points0, equal_nan=True)
+    assert np.all(np.isfinite(filtered))
+    assert len(filtered) == len(filter_grid(points[np.isfinite(points).all(axis=1)], 0.5, keep=keep))
+    if keep != 'centroid':
+        ind = filter_grid(points, 0.5, keep=keep, only_mask=True)
+        assert np.all(np.isfinite(points[ind]))
+
+    # empty and all-NaN clouds give empty results
+    assert len(filter_grid(np.full((10, 3), np.nan, dtype=np.float32), 0.5, keep=keep)) == 0
+    assert len(filter_grid(np.zeros((0, 3), dtype=np.float32), 0.5, keep=keep)) == 0
+
+
+def test_filter_grid_point_cloud():
+    data = np.concatenate([random_cloud(200), np.arange(200, dtype=np.float32)[:, None]], axis=1)
+    cloud = PointCloud(data, fields=('x', 'y', 'z', 'intensity'))
+    filtered = filter_grid(cloud, 0.5, keep='centroid')
+    assert isinstance(filtered, PointCloud) and filtered.fields == cloud.fields
+    assert np.array_equal(cloud.data, data)
+
+
+def test_segment_ground():
+    # range image of a flat ground with a wall in the middle columns
+    H, W = 16, 32
+    elev = np.linspace(-0.4, -0.05, H)[:, None]
+    azim = np.linspace(-0.5, 0.5, W)[None]
+    r = np.broadcast_to(1.5 / np.tan(-elev), (H, W)).copy()
+    z = np.full((H, W), -1.5)
+    wall = (r > 6.) & (np.abs(azim) < 0.2)
+    r[wall] = 6.
+    z[wall] = 6. * np.tan(np.broadcast_to(elev, (H, W))[wall])
+    points = np.stack([r * np.cos(azim), r * np.sin(azim), z], axis=-1)
+    points[0, 0] = np.nan
+    # beams are not ordered by elevation
+    perm = np.random.default_rng(0).permutation(H)
+    ground, obstacle, height = segment_ground(points[perm], return_height=True)
+    ground, obstacle, height = ground[np.argsort(perm)], obstacle[np.argsort(perm)], height[np.argsort(perm)]
+    valid = np.isfinite(points).all(axis=2)
+    # the lowest wall points are a gentle slope from the ground
+    wall &= z > -1.4
+    assert np.array_equal(obstacle, wall & valid)
+    assert np.array_equal(ground, ~wall & valid)
+    assert np.allclose(height[ground], 0.)
+    assert np.all(height[obstacle] > 0.) and np.all(np.isnan(height[~valid]))
+
+
+def footprint_poses(n=12):
+    # curved trajectory climbing a slope
+    poses = np.tile(np.eye(4), (n, 1, 1))
+    yaw = np.linspace(0., 1.2, n)
+    rpy = np.stack([np.full(n, 0.05), np.full(n, -0.2), yaw], axis=1)
+    poses[:, :3, :3] = Rotation.from_euler('xyz', rpy).as_matrix()
+    poses[:, 0, 3] = 1.3 * np.sin(yaw) / 0.4
+    poses[:, 1, 3] = 1.3 * (1. - np.cos(yaw)) / 0.4
+    poses[:, 2, 3] = 0.3 + 0.2 * poses[:, 0, 3]
+    return poses
+
+
+def footprint_points(poses, length, width, step):
+    # dense footprint points, the point-based reference of the rasterization
+    x, y = np.meshgrid(np.arange(-length / 2 + step / 2, length / 2, step),
+                       np.arange(-width / 2 + step / 2, width / 2, step))
+    points = np.stack([x.ravel(), y.ravel(), np.zeros(x.size), np.ones(x.size)], axis=-1)
+    return np.concatenate([(points @ pose.T)[:, :3] for pose in poses])
+
+
+def test_rasterize_footprints_matches_points():
+    poses = footprint_poses()
+    length, width, d_max, res = 1.0, 0.7, 6.4, 0.1
+    hm = rasterize_footprints(poses, length, width, d_max=d_max, grid_res=res, h_max_above_ground=3.)
+    ref = estimate_heightmap(footprint_points(poses, length, width, res / 8), d_min=0., d_max=d_max, grid_res=res,
+                             h_max_above_ground=3., hm_interp_method=None)
+    mask, mask_ref = hm['mask'] > 0, ref['mask'] > 0
+    assert mask.sum() > 100
+
+    # cells covered only by one of them are at the footprint borders
+    cells = np.stack([hm['x'].T, hm['y'].T], axis=-1)
+    inner = np.zeros_like(mask)
+    outer = np.zeros_like(mask)
+    border = np.zeros_like(mask)
+    for pose in poses:
+        ab = np.einsum('ij,...j->...i', np.linalg.inv(pose[:2, :2]), cells - pose[:2, 3])
+        pose_inner = (np.abs(ab[..., 0]) <= length / 2 - res) & (np.abs(ab[..., 1]) <= width / 2 - res)
+        pose_outer = (np.abs(ab[..., 0]) <= length / 2 + res) & (np.abs(ab[..., 1]) <= width / 2 + res)
+        inner |= pose_inner
+        outer |= pose_outer
+        border |= pose_outer & ~pose_inner
+    assert np.all(mask[inner]) and np.all(mask_ref[inner])
+    assert not np.any(mask[~outer]) and not np.any(mask_ref[~outer])
+    assert (mask != mask_ref).sum() < 0.25 * mask.sum()
+
+    # heights of the points in a cell and of the footprint planes at its center differ by the slope over a cell,
+    # at the footprint borders the points of higher footprints not covering the center may be in the cell
+    tol = 0.25 * res
+    both = mask & mask_ref
+    assert np.all(hm['z'][both] <= ref['z'][both] + tol)
+    assert (both & ~border).sum() > 20
+    assert np.allclose(hm['z'][both & ~border], ref['z'][both & ~border], atol=tol)
+    assert np.all(hm['z_min'][mask] <= hm['z'][mask])
+    assert np.all(hm['z'][~mask] == 0.) and np.all(hm['z_min'][~mask] == 0.)
+
+
+def test_rasterize_footprints_single_pose():
+    pose = np.eye(4)
+    pose[:3, 3] = [1.05, -0.95, 0.2]
+    hm = rasterize_footprints(pose[None], length=0.4, width=0.2, d_max=2., grid_res=0.1)
+    mask = hm['mask'] > 0
+    # cell centers within the rectangle
+    inside = (np.abs(hm['x'].T - 1.05) <= 0.2) & (np.abs(hm['y'].T + 0.95) <= 0.1)
+    assert np.array_equal(mask, inside)
+    assert np.allclose(hm['z'][mask], 0.2) and np.allclose(hm['z_min'][mask], 0.2)
+
+
+def test_rasterize_footprints_into_heightmap():
+    pose = np.eye(4)
+    pose[2, 3] = 0.1
+    obstacles = np.array([[0., 0., 0.5], [1., 1., 0.3]])
+    hm_obstacles = estimate_heightmap(obstacles, d_min=0., d_max=2., grid_res=0.1, hm_interp_method=None)
+    hm = rasterize_footprints(pose[None], length=0.4, width=0.4, d_max=2., grid_res=0.1, heightmap=hm_obstacles)
+    obstacle_mask = hm_obstacles['mask'] > 0
+    # obstacles are kept, the footprint below the obstacle gives the minimum
+    assert np.all(hm['mask'][obstacle_mask] > 0)
+    assert np.allclose(hm['z'][obstacle_mask], hm_obstacles['z'][obstacle_mask])
+    i, j = np.argwhere(obstacle_mask & (hm_obstacles['z'] > 0.4))[0]
+    assert np.isclose(hm['z_min'][i, j], 0.1)
@@ -0,0 +1,43 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from monoforce.datasets.collate import collate_points
+from monoforce.datasets.sample import Sample
+
+
+def points_samples(sizes=(5, 9, 1)):
+    rng = np.random.default_rng(0)
+    return [(torch.full((2, 2), k, dtype=torch.uint8), torch.tensor(float(k)),
+             torch.as_tensor(rng.normal(size=(3, n)), dtype=torch.float32)) for k, n in enumerate(sizes)]
+
+
+def test_collate_points():
+    samples = points_samples()
+    batch = collate_points(samples)
+    assert len(batch) == 4
+    imgs, values, points, lengths = batch
+    assert imgs.dtype == torch.uint8 and imgs.shape == (3, 2, 2)
+    assert torch.equal(values, torch.tensor([0., 1., 2.]))
+    assert points.shape == (3, 3, 9) and torch.equal(lengths, torch.tensor([5, 9, 1]))
+    for k, (_, _, cloud) in enumerate(samples):
+        n = cloud.shape[-1]
+        assert torch.equal(points[k, :, :n], cloud)
+        assert torch.all(points[k, :, n:] == 0)
+
+
+def test_collate_points_samples():
+    samples = [Sample(hm_geom=torch.ones((2, 4, 4)) * k, points=cloud) for k, (_, _, cloud) in
+               enumerate(points_samples())]
+    batch = collate_points(samples)
+    assert isinstance(batch, Sample)
+    assert batch.hm_geom.shape == (3, 2, 4, 4)
+    assert batch.points.shape == (3, 3, 9) and torch.equal(batch.points_lengths, torch.tensor([5, 9, 1]))
+    assert torch.equal(batch.points[2, :, :1], samples[2]['points'])
+    assert batch.to('cpu').points_lengths.dtype == torch.int64
+
+
+def test_collate_points_loader():
+    loader = DataLoader(points_samples((4, 2, 7, 3)), batch_size=2, collate_fn=collate_points)
+    lengths = [batch[-1].tolist() for batch in loader]
+    assert lengths == [[4, 2], [7, 3]]
+    assert [tuple(batch[-2].shape) for batch in loader] == [(2, 3, 4), (2, 3, 7)]
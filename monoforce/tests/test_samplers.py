@@ -0,0 +1,35 @@
+import numpy as np
+from torch.utils.data import ConcatDataset
+from monoforce.datasets.samplers import ChunkShuffleSampler
+
+
+def test_chunk_shuffle_sampler():
+    ds = ConcatDataset([list(range(10)), list(range(7)), list(range(5))])
+    sampler = ChunkShuffleSampler(ds, chunk_size=4, shuffle_within_chunks=False)
+    assert len(sampler) == 22
+    indices = list(sampler)
+    assert sorted(indices) == list(range(22))
+
+    # chunks of consecutive samples do not cross the sequences
+    starts = [0, 10, 17]
+    assert len(sampler.chunks) == 3 + 2 + 2
+    for chunk in sampler.chunks:
+        assert np.array_equal(chunk, np.arange(chunk[0], chunk[-1] + 1))
+        assert np.searchsorted(starts, chunk[0], side='right') == np.searchsorted(starts, chunk[-1], side='right')
+    positions = {int(chunk[0]): k for k, chunk in enumerate(sampler.chunks)}
+    k = 0
+    while k < len(indices):
+        chunk = sampler.chunks[positions[indices[k]]]
+        assert indices[k:k + len(chunk)] == list(chunk)
+        k += len(chunk)
+
+
+def test_chunk_shuffle_sampler_shuffles():
+    np.random.seed(0)
+    sampler = ChunkShuffleSampler(list(range(40)), chunk_size=8)
+    orders = [list(sampler) for _ in range(3)]
+    assert all(sorted(order) == list(range(40)) for order in orders)
+    assert orders[0] != orders[1]
+    # samples of a chunk stay together
+    for order in orders:
+        assert all(len({i // 8 for i in order[k:k + 8]}) == 1 for k in range(0, 40, 8))
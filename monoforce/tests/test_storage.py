@@ -0,0 +1,92 @@
+import os
+import pickle
+import numpy as np
+import pytest
+from monoforce.cloudproc import PointCloud
+from monoforce.datasets.storage import ShardedArrayWriter, ShardedArrays, TerrainStore, CloudStoreWriter, CloudStore
+
+
+def test_sharded_arrays(tmp_path):
+    path = str(tmp_path / 'samples')
+    rng = np.random.default_rng(0)
+    samples = [{'height': rng.normal(size=(4, 5)).astype(np.float32), 'img': rng.integers(0, 255, (2, 3, 3))}
+               for _ in range(7)]
+    fields = {'height': ((4, 5), 'float32'), 'img': ((2, 3, 3), 'uint8')}
+    writer = ShardedArrayWriter(path, len(samples), fields=fields, shard_size=3, meta={'grid_res': 0.1})
+    for i, sample in enumerate(samples):
+        writer.write(i, sample)
+    assert not os.path.exists(path)
+    writer.close()
+
+    store = ShardedArrays(path)
+    assert len(store) == len(samples) and store.meta == {'grid_res': 0.1}
+    for i, sample in enumerate(samples):
+        assert np.array_equal(store.get(i, 'height'), sample['height'])
+        assert store[i]['img'].dtype == np.uint8 and np.array_equal(store[i]['img'], sample['img'])
+    store = pickle.loads(pickle.dumps(store))
+    assert np.array_equal(store.get(6, 'height'), samples[6]['height'])
+    with pytest.raises(AssertionError):
+        store.get(7, 'height')
+
+
+def test_terrain_store(tmp_path):
+    path = str(tmp_path / 'terrain' / 'store')
+    ids = ['%06d' % i for i in range(10)]
+    rng = np.random.default_rng(0)
+    height = rng.uniform(-2., 2., size=(16, 16)).astype(np.float32)
+    mask = rng.uniform(size=(16, 16)) > 0.5
+
+    store = TerrainStore(path, ids, flush_every=2)
+    assert store.get(ids[3]) is None
+    hm = store.put(ids[3], height, mask)
+    # float16 heights, exact masks
+    assert hm.shape == (2, 16, 16)
+    assert np.allclose(hm[0], height, atol=2. * 2 ** -11)
+    assert np.array_equal(hm[1], mask.astype(np.float32))
+    assert np.array_equal(store.get(ids[3]), hm)
+
+    # samples are valid for other readers only after they are flushed
+    assert TerrainStore(path, ids).get(ids[3]) is None
+    store.put(ids[5], -height, ~mask)
+    reader = TerrainStore(path, ids)
+    assert np.array_equal(reader.get(ids[3]), hm)
+    assert np.array_equal(reader.get(ids[5])[1], (~mask).astype(np.float32))
+    store.put(ids[7], height, mask)
+    assert reader.get(ids[7]) is None
+    store.flush()
+    assert np.array_equal(TerrainStore(path, ids).get(ids[7]), hm)
+    assert reader.get(ids[0]) is None and reader.get('unknown') is None
+
+    with pytest.raises(AssertionError):
+        store.put(ids[0], height[:8], mask[:8])
+
+
+def test_cloud_store(tmp_path):
+    path = str(tmp_path / 'clouds')
+    rng = np.random.default_rng(0)
+    resolution = 0.005
+    clouds = [rng.uniform(-50., 50., size=(n, 3)).astype(np.float32) for n in [100, 0, 37]]
+    intensities = [rng.uniform(0., 100., size=len(c)).astype(np.float32) for c in clouds]
+    clouds[2][0] = [200., 0., 0.]
+    clouds[2][1, 2] = np.nan
+
+    writer = CloudStoreWriter(path, resolution=resolution, intensity=True)
+    for i, (cloud, intensity) in enumerate(zip(clouds, intensities)):
+        writer.write(i, cloud, intensity)
+    writer.close()
+    # points out of the range of int16 multiples of the resolution and non-finite points are dropped
+    assert writer.n_dropped == 2
+
+    store = CloudStore(path)
+    assert CloudStore.exists(path) and len(store) == 3
+    for i, (cloud, intensity) in enumerate(zip(clouds, intensities)):
+        valid = np.isfinite(cloud).all(axis=1) & (np.abs(cloud) < 160.).all(axis=1)
+        stored = store.get(i)
+        assert isinstance(stored, PointCloud) and stored.fields == ('x', 'y', 'z', 'intensity')
+        assert stored.data.shape == (valid.sum(), 4)
+        # quantization error is at most half of the resolution
+        assert np.all(np.abs(stored.data[:, :3] - cloud[valid]) <= resolution / 2 + 1e-5)
+        assert np.allclose(stored['intensity'], intensity[valid], rtol=1e-3)
+    assert store.get(3) is None and store.get_points('3') is None
+    store = pickle.loads(pickle.dumps(store))
+    assert np.array_equal(store.get_points(0), CloudStore(path).get_points(0))
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from monoforce.models.terrain_encoder.utils import augment_imgs, img_transform, normalize_img
+
+
+def ramp_image(H, W):
+    # smooth image, interpolated alike by PIL and grid sampling
+    v, u = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+    img = np.stack([40 + 2 * u, 30 + 2 * v, 200 - u - v], axis=-1)
+    return img.clip(0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize('flip, rotate', [(False, 0.), (True, 0.), (False, 4.), (True, -3.)])
+def test_augment_imgs_matches_img_transform(flip, rotate):
+    H, W = 60, 80
+    raw = ramp_image(H, W)
+    resize, resize_dims, crop = 0.5, (40, 30), (4, 3, 36, 27)
+    img, post_rot, post_tran = img_transform(Image.fromarray(raw), torch.eye(2), torch.zeros(2), resize=resize,
+                                             resize_dims=resize_dims, crop=crop, flip=flip, rotate=rotate)
+    ref = normalize_img(img)
+
+    post_rots = torch.eye(3)
+    post_trans = torch.zeros(3)
+    post_rots[:2, :2] = post_rot
+    post_trans[:2] = post_tran
+    imgs = augment_imgs(torch.from_numpy(raw)[None, None], post_rots[None, None], post_trans[None, None],
+                        raw_size=(H, W), final_dim=(crop[3] - crop[1], crop[2] - crop[0]))
+    assert imgs.shape == (1, 1) + tuple(ref.shape)
+    # borders are filled differently and rotated images are sampled with the nearest pixels by PIL
+    inner = (slice(None), slice(3, -3), slice(3, -3))
+    assert torch.allclose(imgs[0, 0][inner], ref[inner], atol=0.06)
+
+
+def test_augment_imgs_raw_resolution():
+    # downscaled images with the raw aspect ratio give the same result
+    H, W = 60, 80
+    raw = ramp_image(H, W)
+    small = np.array(Image.fromarray(raw).resize((W // 2, H // 2), Image.BILINEAR))
+    post_rots = torch.eye(3)[None, None]
+    post_trans = torch.zeros(3)[None, None]
+    imgs = augment_imgs(torch.from_numpy(raw)[None, None], post_rots, post_trans, raw_size=(H, W), final_dim=(H, W))
+    imgs_small = augment_imgs(torch.from_numpy(small)[None, None], post_rots, post_trans,
+                              raw_size=(H, W), final_dim=(H, W))
+    inner = (slice(None), slice(None), slice(None), slice(2, -2), slice(2, -2))
+    assert torch.allclose(imgs[inner], imgs_small[inner], atol=0.05)
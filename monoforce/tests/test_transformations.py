@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+import torch
+from scipy.spatial.transform import Rotation
+from monoforce.transformations import transform_cloud, transform_clouds, poses_to_states
+
+
+def random_pose(rng):
+    T = np.eye(4)
+    T[:3, :3] = Rotation.random(random_state=rng).as_matrix()
+    T[:3, 3] = rng.normal(size=3)
+    return T
+
+
+def circle_poses(v=1.5, w=0.4, dt=0.1, n=50):
+    # constant yaw rate trajectory: a circle of radius v / w driven forward
+    ts = dt * np.arange(n)
+    yaw = w * ts
+    poses = np.tile(np.eye(4), (n, 1, 1))
+    poses[:, :3, :3] = Rotation.from_euler('z', yaw[:, None]).as_matrix()
+    poses[:, 0, 3] = v / w * np.sin(yaw)
+    poses[:, 1, 3] = v / w * (1. - np.cos(yaw))
+    return ts, poses
+
+
+def test_poses_to_states_constant_yaw_rate():
+    v, w, dt = 1.5, 0.4, 0.1
+    ts, poses = circle_poses(v, w, dt)
+    xs, xds, Rs, omegas = poses_to_states(poses, ts)
+    assert np.allclose(xs, poses[:, :3, 3]) and np.allclose(Rs, poses[:, :3, :3])
+    # rotation of a constant rate, the velocity along the chord of each step
+    assert np.allclose(omegas[:-1], [0., 0., w])
+    speed = np.linalg.norm(xds[:-1], axis=1)
+    assert np.allclose(speed, 2 * v / w * np.sin(w * dt / 2) / dt)
+    assert np.allclose(xds[-1], 0.) and np.allclose(omegas[-1], 0.)
+
+    _, xds_body, _, omegas_body = poses_to_states(poses, ts, body_frame=True)
+    chord_yaw = w * dt / 2
+    assert np.allclose(xds_body[:-1], speed[:, None] * [np.cos(chord_yaw), np.sin(chord_yaw), 0.])
+    assert np.allclose(omegas_body[:-1], [0., 0., w])
+
+
+def test_poses_to_states_batch_and_stamps():
+    ts, poses = circle_poses(n=10)
+    ts = ts.copy()
+    ts[5] = ts[4]
+    xs, xds, Rs, omegas = poses_to_states(np.stack([poses, poses]), np.stack([ts, ts]))
+    assert xds.shape == (2, 10, 3) and Rs.shape == (2, 10, 3, 3)
+    # non-increasing stamps give zero velocities
+    assert np.allclose(xds[:, 4], 0.) and np.allclose(omegas[:, 4], 0.)
+    assert np.all(np.isfinite(xds)) and np.all(np.isfinite(omegas))
+
+
+def test_transform_cloud():
+    rng = np.random.default_rng(0)
+    T = random_pose(rng)
+    cloud = rng.normal(size=(100, 3)).astype(np.float32)
+    cloud0 = cloud.copy()
+    ref = cloud.astype(np.float64) @ T[:3, :3].T + T[:3, 3]
+
+    out = transform_cloud(cloud, T)
+    assert out.dtype == np.float32 and np.allclose(out, ref, atol=1e-5)
+    assert np.array_equal(cloud, cloud0)
+    out_t = transform_cloud(torch.from_numpy(cloud), T)
+    assert out_t.dtype == torch.float32 and np.allclose(out_t.numpy(), ref, atol=1e-5)
+
+    # integer clouds are transformed to float32 and can not be transformed in place
+    out_int = transform_cloud(cloud0.round().astype(np.int32), T)
+    assert out_int.dtype == np.float32
+    with pytest.raises(AssertionError):
+        transform_cloud(cloud0.round().astype(np.int32), T, inplace=True)
+
+    assert transform_cloud(cloud, T, inplace=True) is cloud
+    assert np.allclose(cloud, ref, atol=1e-5)
+
+
+def test_transform_cloud_structured():
+    rng = np.random.default_rng(1)
+    T = random_pose(rng)
+    cloud = np.zeros(50, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('intensity', 'f4')])
+    for f in ['x', 'y', 'z', 'intensity']:
+        cloud[f] = rng.normal(size=50)
+    cloud0 = cloud.copy()
+    out = transform_cloud(cloud, T)
+    xyz = np.stack([cloud0[f] for f in 'xyz'], axis=1)
+    assert np.allclose(np.stack([out[f] for f in 'xyz'], axis=1), xyz @ T[:3, :3].T + T[:3, 3], atol=1e-5)
+    assert np.array_equal(out['intensity'], cloud0['intensity'])
+    assert np.array_equal(cloud, cloud0)
+
+
+def test_transform_clouds():
+    rng = np.random.default_rng(2)
+    poses = np.stack([random_pose(rng) for _ in range(5)])
+    points = rng.normal(size=(20, 3)).astype(np.float32)
+    out = transform_clouds(poses, points)
+    assert out.shape == (5, 20, 3) and out.dtype == np.float32
+    for T, points_tr in zip(poses, out):
+        assert np.allclose(points_tr, transform_cloud(points, T), atol=1e-5)
+    out_t = transform_clouds(torch.from_numpy(poses), torch.from_numpy(points))
+    assert np.allclose(out_t.numpy(), out, atol=1e-5)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from monoforce.utils import Calibration, interp_windows, nearest_index
+
+
+def camera(fx):
+    return {'camera_matrix': {'data': [fx, 0., 320., 0., fx, 240., 0., 0., 1.]},
+            'distortion_coefficients': {'data': [0.1, -0.01, 0., 0., 0.]}}
+
+
+def transform(x):
+    T = np.eye(4)
+    T[0, 3] = x
+    return {'data': T.ravel().tolist()}
+
+
+def calibration():
+    cameras = {'camera_left': camera(500.), 'camera_left_rect': camera(400.), 'camera_front': camera(600.)}
+    transformations = {'T_base_link__base_footprint': transform(0.),
+                       'T_base_link__camera_left_rect': transform(1.),
+                       'T_base_link__camera_front': transform(2.),
+                       'T_base_footprint__camera_front': transform(3.)}
+    return Calibration(cameras, transformations)
+
+
+def test_calibration_cameras():
+    calib = calibration()
+    assert calib.cameras == ['camera_front', 'camera_left', 'camera_left_rect']
+    E, K, D = calib.get_camera('camera_front')
+    assert E[0, 3] == 2. and K[0, 0] == 600. and D.shape == (5,)
+    assert calib.get_camera('camera_front', robot_frame='base_footprint')[0][0, 3] == 3.
+    assert np.array_equal(calib.Ks[calib.camera_indices(['camera_left_rect', 'camera_front'])][:, 0, 0], [400., 600.])
+    assert not calib.Ks.flags.writeable and not calib.Es.flags.writeable
+
+
+def test_calibration_camera_names():
+    calib = calibration()
+    # exact names are preferred, parts of the names are matched only on request
+    assert calib.camera_index('camera_left') == 1
+    assert calib.camera_index('camera_left', fuzzy=True) == 1
+    assert calib.camera_index('front', fuzzy=True) == 0
+    with pytest.raises(KeyError):
+        calib.camera_index('front')
+    with pytest.raises(KeyError):
+        calib.camera_index('camera_up', fuzzy=True)
+
+
+def test_calibration_missing_extrinsics():
+    calib = calibration()
+    # the intrinsics are available, the missing extrinsics are not returned
+    assert calib.Ks[calib.camera_index('camera_left')][0, 0] == 500.
+    with pytest.raises(KeyError):
+        calib.get_camera('camera_left')
+    assert calib.get_camera('camera_left_rect')[0][0, 3] == 1.
+
+
+def test_nearest_index():
+    stamps = np.array([0., 1., 2., 4.])
+    assert np.array_equal(nearest_index(stamps, np.array([-1., 0.4, 0.5, 2.9, 3.1, 10.])), [0, 0, 0, 2, 3, 3])
+    assert nearest_index(stamps, 1.6) == 2
+    assert nearest_index(np.array([5.]), 1.) == 0
+
+
+def test_interp_windows():
+    rng = np.random.default_rng(0)
+    stamps = np.sort(rng.uniform(0., 10., 50))
+    values = rng.normal(size=(50, 2))
+    il, ir = np.array([0, 10, 30]), np.array([20, 25, 50])
+    t = np.stack([np.linspace(stamps[l] - 1., stamps[r - 1] + 1., 15) for l, r in zip(il, ir)])
+    out = interp_windows(t, stamps, values, il, ir)
+    assert out.shape == (3, 15, 2)
+    # np.interp restricted to each window
+    for k, (l, r) in enumerate(zip(il, ir)):
+        for c in range(2):
+            assert np.allclose(out[k, :, c], np.interp(t[k], stamps[l:r], values[l:r, c]))